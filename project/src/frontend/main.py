@@ -1,4 +1,3 @@
-import requests
 """
 El código define una aplicación de Streamlit que interactúa con un servicio backend para procesar la entrada del usuario, mostrar mensajes 
 de chat y mostrar resultados de búsqueda con botones clicables.
@@ -9,98 +8,55 @@ el parámetro query se utiliza para construir la URL para la consulta.
 query: str
 """        
 import json
+import os
 import time
+import httpx
 import streamlit as st
-import sseclient  # sseclient-py
+from sse import stream_events
 
 
-def backend_call(query: str):
-    """
-La función `backend_call` realiza una solicitud HTTP GET en streaming a una URL especificada y genera eventos desde la respuesta del servidor de 
-forma indefinida.
-- `query`: La función `backend_call` toma un parámetro `query`, que es una cadena de texto que representa la consulta de búsqueda que se enviará 
-al servidor backend para su procesamiento. La función luego construye una URL con el parámetro de consulta y realiza una solicitud GET en 
-streaming al servidor. Utiliza Eventos Enviados por el Servidor (SSE).
-- `type query`: str
-    """
-    url = f"http://orchestrator/streamingSearch?query={query}"
-    stream_response = requests.get(url, stream=True)
-    client = sseclient.SSEClient(stream_response)  # type: ignore
-
-    # Loop forever (while connection "open")
-    for event in client.events():
-        yield event
-        
-from requests.exceptions import ChunkedEncodingError
-import time
+BACKEND_URL = os.environ.get("BACKEND_URL", "http://orchestrator:80/streamingSearch")
+# Segundos mínimos entre dos re-renderizados de la respuesta mientras llegan tokens.
+RENDER_INTERVAL = float(os.environ.get("RENDER_INTERVAL", 0.1))
+
+
+@st.cache_resource
+def http_client() -> httpx.Client:
+    """Un cliente HTTP por proceso de Streamlit, de modo que las preguntas siguientes reutilizan sus conexiones al backend."""
+    # El servidor envía pings cada 15 segundos, así que una lectura más larga indica una conexión perdida.
+    return httpx.Client(timeout=httpx.Timeout(10.0, read=60.0))
 
-from sseclient import SSEClient
-
-class CustomSSEClient(SSEClient):
-    def events(self):
-        data = b""  # Asegúrate de que data sea de tipo bytes
-        for chunk in self._read():
-            if isinstance(chunk, str):
-                chunk = chunk.encode('utf-8')  # Convierte chunk a bytes si es una cadena
-            elif isinstance(chunk, bytes):
-                pass  # Ya es bytes, no se necesita conversión
-            else:
-                continue  # Maneja otros tipos de datos si es necesario
-
-            data += chunk
-            for line in data.decode(self._char_enc).splitlines():
-                if line.startswith(':'):
-                    continue
-                if not line:
-                    yield event
-                    event = self._event_class()
-                    continue
-                data = line.split(':', 1)
-                field = data[0]
-                if len(data) > 1:
-                    value = data[1].lstrip()
-                else:
-                    value = ''
-                if field == 'data':
-                    event.data += value + '\n'
-                elif field == 'event':
-                    event.event = value
-                elif field == 'id':
-                    event.id = value
-                elif field == 'retry':
-                    try:
-                        event.retry = int(value)
-                    except ValueError:
-                        pass
-        if event.data:
-            yield event
-
-
-from requests.exceptions import RequestException
 
 def backend_call(prompt):
+    """
+La función `backend_call` realiza una solicitud HTTP GET en streaming al backend y genera los eventos de la respuesta a medida que llegan.
+- `prompt`: La consulta del usuario que se envía al backend como parámetro `query`. Si la conexión falla antes de recibir el primer evento
+se reintenta con espera exponencial; una vez recibidos eventos no se reintenta, porque se repetiría la respuesta.
+- `type prompt`: str
+    """
     max_retries = 5
     retry_delay = 2
-    timeout = 10
 
     for attempt in range(max_retries):
+        received = False
         try:
-            url = f"http://orchestrator:80/streamingSearch?query={prompt}"
-            response = requests.get(url, stream=True, timeout=timeout)
-            response.raise_for_status()
-            client = CustomSSEClient(response)
-            for event in client.events():
+            for event in stream_events(http_client(), BACKEND_URL, {"query": prompt}):
+                received = True
                 yield event
-            break
-        except RequestException as e:
+            return
+        except httpx.HTTPError as e:
             print(f"Intento {attempt + 1} fallido: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay)
-                retry_delay *= 2
-            else:
-                print("No se pudo establecer conexión con el backend después de múltiples intentos.")
+            if received or attempt == max_retries - 1:
+                print("No se pudo completar la respuesta del backend.")
                 raise
-
+            # Un backend saturado responde 429 o 503 indicando cuándo reintentar.
+            retry_after = (
+                e.response.headers.get("Retry-After")
+                if isinstance(e, httpx.HTTPStatusError)
+                else None
+            )
+            time.sleep(float(retry_after) if retry_after else retry_delay)
+            retry_delay *= 2
 
 
 def display_chat_messages():
@@ -136,16 +92,30 @@ cualquier otra forma de entrada del usuario que el sistema backend necesite mane
     columns = st.columns(2)
     button_count = 0
     button_placeholders, message_placeholder = [], None
+    last_render = 0.0
+    retry_after = None
     with st.spinner("Thinking..."):
         for chunk in backend_call(prompt):
             button_count, button_placeholders = display_backend_response(
                 chunk, button_count, columns, button_placeholders
             )
-            full_response, message_placeholder = process_chunk_event(
-                chunk, full_response, message_placeholder
+            full_response, message_placeholder, last_render = process_chunk_event(
+                chunk, full_response, message_placeholder, last_render
             )
-
-    st.session_state.messages.append({"role": "assistant", "content": full_response})
+            # El backend saturado responde solo desde la caché y, si no tiene nada, indica cuándo reintentar.
+            if chunk.event == "degraded":
+                st.caption("The service is busy, answering from cached pages only.")
+            elif chunk.event == "no_cached_answer":
+                retry_after = json.loads(chunk.data).get("retry_after")
+    # Render final sin el cursor, incluye los tokens que llegaron después del último re-renderizado.
+    if message_placeholder:
+        message_placeholder.markdown(full_response)
+
+    if retry_after is not None:
+        st.warning(f"The service is busy, please retry in {retry_after} s.")
+    # Una respuesta vacía no se guarda en el historial.
+    if full_response:
+        st.session_state.messages.append({"role": "assistant", "content": full_response})
 
 
 def display_backend_response(chunk, button_count, columns, button_placeholders):
@@ -174,7 +144,6 @@ le asigna una etiqueta basada en el enlace del ítem y una clave única. Los mar
             )
             button_count += 1
             button_placeholders.append(button_placeholder)
-            time.sleep(0.05)
     return button_count, button_placeholders
 
 
@@ -194,7 +163,7 @@ usuario. Cada marcador de posición representa un botón que se puede crear din
     )
 
 
-def process_chunk_event(chunk, full_response, message_placeholder):
+def process_chunk_event(chunk, full_response, message_placeholder, last_render):
     """
     La función `process_chunk_event` procesa un evento de fragmento actualizando una respuesta completa y mostrándola con un marcador de posición 
     de mensaje en formato markdown.
@@ -206,14 +175,19 @@ de fragmentos individuales.
 - `message_placeholder`: El parámetro `message_placeholder` es un elemento marcador de posición que puede usarse para mostrar mensajes o contenido
  en una aplicación de Streamlit. En la función proporcionada `process_chunk_event`, si `message_placeholder` no se proporciona (es decir, si es 
  `None`), se crea un nuevo marcador de posición vacío usando
-- `return`: La función `process_chunk_event` devuelve dos valores: `full_response` y `message_placeholder`.
+- `last_render`: Momento (`time.monotonic()`) del último re-renderizado. La respuesta solo se vuelve a dibujar si pasaron `RENDER_INTERVAL`
+segundos, así una respuesta larga no se re-renderiza entera con cada token.
+- `return`: La función `process_chunk_event` devuelve tres valores: `full_response`, `message_placeholder` y `last_render`.
     """
     if chunk.event == "token":
         if not message_placeholder:
             message_placeholder = st.empty()
         full_response += chunk.data
-        message_placeholder.markdown(full_response + "▌")
-    return full_response, message_placeholder
+        now = time.monotonic()
+        if now - last_render >= RENDER_INTERVAL:
+            message_placeholder.markdown(full_response + "▌")
+            last_render = now
+    return full_response, message_placeholder, last_render
 
 
 # El fragmento de código es un script de Python que utiliza Streamlit, una biblioteca popular para crear aplicaciones web con Python. 
@@ -0,0 +1,131 @@
+# Cliente de Server-Sent Events incremental: cada fragmento recibido se decodifica una sola vez y solo se guarda la última línea
+# incompleta, de modo que leer una respuesta larga cuesta O(n) aunque los fragmentos corten líneas o caracteres UTF-8 multibyte.
+import codecs
+import re
+from typing import Iterable, Iterator, Optional
+
+import httpx
+
+LINE_END = re.compile(r"\r\n|\r|\n")
+
+
+class Event:
+    __slots__ = ("event", "data", "id", "retry")
+
+    def __init__(
+        self,
+        event: str = "message",
+        data: str = "",
+        id: Optional[str] = None,
+        retry: Optional[int] = None,
+    ) -> None:
+        self.event = event
+        self.data = data
+        self.id = id
+        self.retry = retry
+
+    def __repr__(self) -> str:
+        return f"Event(event={self.event!r}, data={self.data!r})"
+
+
+class SSEParser:
+    """Incremental parser of an event stream, following the WHATWG format."""
+
+    def __init__(self, encoding: str = "utf-8") -> None:
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        # Pieces of the last unterminated line, joined only when it ends.
+        self._partial: list[str] = []
+        self._event: Optional[str] = None
+        self._data: list[str] = []
+        self._id: Optional[str] = None
+        self._retry: Optional[int] = None
+        # A chunk ending in \r may be followed by the \n of the same line ending.
+        self._skip_lf = False
+
+    def feed(self, chunk: bytes) -> list[Event]:
+        """Parses a chunk, returning the events it completes."""
+
+        return self._feed_text(self._decoder.decode(chunk))
+
+    def close(self) -> list[Event]:
+        """Flushes the decoder; an event not terminated by a blank line is discarded."""
+
+        events = self._feed_text(self._decoder.decode(b"", final=True))
+        self._partial = []
+        return events
+
+    def _feed_text(self, text: str) -> list[Event]:
+        if not text:
+            return []
+        if self._skip_lf and text.startswith("\n"):
+            text = text[1:]
+        self._skip_lf = text.endswith("\r")
+
+        # Only the new text is scanned; a line split across chunks is joined once.
+        events = []
+        start = 0
+        for match in LINE_END.finditer(text):
+            line = text[start : match.start()]
+            if self._partial:
+                line = "".join(self._partial) + line
+                self._partial = []
+            event = self._line(line)
+            start = match.end()
+            if event is not None:
+                events.append(event)
+        if start < len(text):
+            self._partial.append(text[start:])
+        return events
+
+    def _line(self, line: str) -> Optional[Event]:
+        if not line:
+            return self._dispatch()
+        if line.startswith(":"):
+            return None
+
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+
+        if field == "data":
+            self._data.append(value)
+        elif field == "event":
+            self._event = value
+        elif field == "id" and "\0" not in value:
+            self._id = value
+        elif field == "retry" and value.isdigit():
+            self._retry = int(value)
+        return None
+
+    def _dispatch(self) -> Optional[Event]:
+        if not self._data:
+            self._event = None
+            return None
+        event = Event(
+            event=self._event or "message",
+            data="\n".join(self._data),
+            id=self._id,
+            retry=self._retry,
+        )
+        self._event = None
+        self._data = []
+        return event
+
+
+def parse(chunks: Iterable[bytes]) -> Iterator[Event]:
+    parser = SSEParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+def stream_events(
+    client: httpx.Client, url: str, params: Optional[dict] = None
+) -> Iterator[Event]:
+    """Streams the events of a GET request over the client's pooled connections."""
+
+    with client.stream(
+        "GET", url, params=params, headers={"Accept": "text/event-stream"}
+    ) as response:
+        response.raise_for_status()
+        yield from parse(response.iter_bytes())
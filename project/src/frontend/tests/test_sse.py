@@ -0,0 +1,30 @@
+from sse import parse
+
+
+def events_of(chunks: list[bytes]) -> list[tuple[str, str]]:
+    return [(event.event, event.data) for event in parse(chunks)]
+
+
+def test_crlf_split_across_chunks():
+    chunks = [b"event: token\r", b"\ndata: hola\r", b"\n\r", b"\n"]
+
+    assert events_of(chunks) == [("token", "hola")]
+
+
+def test_multibyte_characters_split_across_chunks():
+    body = "data: ñandú 😀\n\n".encode("utf-8")
+    chunks = [body[i : i + 1] for i in range(len(body))]
+
+    assert events_of(chunks) == [("message", "ñandú 😀")]
+
+
+def test_multiline_data_is_joined_with_newlines():
+    chunks = [b"data: first\ndata:", b" second\n", b"data: third\n\n"]
+
+    assert events_of(chunks) == [("message", "first\nsecond\nthird")]
+
+
+def test_line_fed_in_many_chunks():
+    chunks = [b"data: "] + [b"x"] * 1000 + [b"\n\n"]
+
+    assert events_of(chunks) == [("message", "x" * 1000)]
@@ -0,0 +1,12 @@
+import os
+
+# La API de Google se lee del entorno al importar retrieval, el benchmark no la usa.
+for variable in (
+    "GOOGLE_API_HOST",
+    "GOOGLE_API_KEY",
+    "GOOGLE_CX",
+    "GOOGLE_FIELDS",
+    "HEADER_ACCEPT_ENCODING",
+    "HEADER_USER_AGENT",
+):
+    os.environ.setdefault(variable, "benchmark")
@@ -0,0 +1,149 @@
+# Benchmark reproducible y sin red del pipeline de recuperación: ejecuta Retriever.get_context de punta a punta contra dobles locales
+# y reporta percentiles de latencia y throughput con caché fría y caliente para varios niveles de concurrencia.
+#
+#   python -m benchmark --concurrency 1 4 16 --rounds 3
+import argparse
+import asyncio
+import json
+import shutil
+import time
+
+import numpy as np
+
+from benchmark.fakes import FIXTURES, FakeEmbeddings, FixtureServer
+from retrieval import Retriever
+from retrieval.cache import RedisVectorCache
+from retrieval.local_cache import LocalVectorCache
+from retrieval.scraper import ScraperLocal
+from retrieval.search import GoogleAPI
+from retrieval.splitter import LangChainSplitter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark of Retriever.get_context."
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument(
+        "--rounds", type=int, default=3, help="Passes over the queries when warm."
+    )
+    parser.add_argument("--cache", choices=["local", "redis"], default="local")
+    parser.add_argument(
+        "--cache-path", default=None, help="Directory of the local cache."
+    )
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--page-latency", type=float, default=0.1)
+    parser.add_argument("--search-latency", type=float, default=0.1)
+    parser.add_argument("--cache-treshold", type=float, default=0.5)
+    parser.add_argument("--doc-treshold", type=float, default=None)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    return parser.parse_args()
+
+
+def make_cache(args, embeddings):
+    """Creates an empty cache."""
+
+    if args.cache == "local":
+        if args.cache_path:
+            shutil.rmtree(args.cache_path, ignore_errors=True)
+        return LocalVectorCache(embeddings.vector_dimension, path=args.cache_path)
+
+    cache = RedisVectorCache(host=args.redis_host, port=args.redis_port)
+    try:
+        cache.init_index(vector_dimension=embeddings.vector_dimension)
+    except Exception:
+        pass
+    keys = list(cache.client.scan_iter("chunks:*"))
+    if keys:
+        cache.client.delete(*keys)
+    return cache
+
+
+async def timed_request(retriever: Retriever, query: str, args) -> float:
+    """Runs one request until its context is ready and returns the elapsed time."""
+
+    start = time.perf_counter()
+    async for event in retriever.get_context(
+        query=query,
+        cache_treshold=args.cache_treshold,
+        k=args.k,
+        doc_treshold=args.doc_treshold,
+    ):
+        if event["event"] == "context":
+            break
+    return time.perf_counter() - start
+
+
+async def run_phase(retriever, queries, concurrency, args) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(query):
+        async with semaphore:
+            return await timed_request(retriever, query, args)
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*[limited(query) for query in queries])
+    elapsed = time.perf_counter() - start
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {
+        "requests": len(latencies),
+        "p50": p50,
+        "p90": p90,
+        "p99": p99,
+        "max": max(latencies),
+        "throughput": len(latencies) / elapsed,
+    }
+
+
+async def main(args):
+    server = FixtureServer(
+        page_latency=args.page_latency, search_latency=args.search_latency
+    )
+    base_url = await server.start()
+
+    embeddings = FakeEmbeddings(latency=args.embedding_latency)
+    retriever = Retriever(
+        cache=make_cache(args, embeddings),
+        searcher=GoogleAPI(host=f"{base_url}/search?"),
+        scraper=ScraperLocal(),
+        embeddings=embeddings,
+        splitter=LangChainSplitter(
+            chunk_size=400, chunk_overlap=50, length_function=len
+        ),
+    )
+    fixture_queries = json.loads((FIXTURES / "queries.json").read_text())
+    queries = [item["query"] for item in fixture_queries]
+
+    report = []
+    try:
+        for concurrency in args.concurrency:
+            retriever.cache = make_cache(args, embeddings)
+            # The cold phase starts from an empty cache, the warm one reuses what it filled.
+            for phase, rounds in (("cold", 1), ("warm", args.rounds)):
+                result = await run_phase(retriever, queries * rounds, concurrency, args)
+                report.append({"concurrency": concurrency, "cache": phase, **result})
+    finally:
+        await server.stop()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(
+        f"{'conc':>4} {'cache':>5} {'reqs':>5} {'p50 ms':>8} {'p90 ms':>8} "
+        f"{'p99 ms':>8} {'max ms':>8} {'req/s':>8}"
+    )
+    for row in report:
+        print(
+            f"{row['concurrency']:>4} {row['cache']:>5} {row['requests']:>5} "
+            f"{row['p50'] * 1000:>8.1f} {row['p90'] * 1000:>8.1f} "
+            f"{row['p99'] * 1000:>8.1f} {row['max'] * 1000:>8.1f} "
+            f"{row['throughput']:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
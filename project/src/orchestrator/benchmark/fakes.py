@@ -0,0 +1,100 @@
+# Dobles locales de los servicios externos del pipeline (Google, las páginas web y el modelo de embeddings) para correr el benchmark
+# sin red y con resultados reproducibles.
+import asyncio
+import hashlib
+import json
+from pathlib import Path
+import re
+from typing import Optional
+
+from aiohttp import web
+import numpy as np
+
+from retrieval.embeddings import Embeddings
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic hashed bag-of-words embeddings with a simulated API latency."""
+
+    vector_dimension = 256
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+
+    async def run(self, chunks: list[str]) -> list[list[float]]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [self.embed(chunk) for chunk in chunks]
+
+    def embed(self, text: str) -> list[float]:
+        vector = np.zeros(self.vector_dimension, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % self.vector_dimension
+            vector[index] += 1.0 if digest[4] % 2 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.tolist()
+
+
+class FixtureServer:
+    """Serves the saved search results and HTML pages over local HTTP."""
+
+    def __init__(self, page_latency: float = 0.0, search_latency: float = 0.0) -> None:
+        self.page_latency = page_latency
+        self.search_latency = search_latency
+        self.search_results = json.loads((FIXTURES / "search.json").read_text())
+        self.runner: Optional[web.AppRunner] = None
+        self.base_url = ""
+
+    async def search(self, request: web.Request) -> web.Response:
+        if self.search_latency:
+            await asyncio.sleep(self.search_latency)
+        query = request.query.get("q", "")
+        topic = self.topic_for(query)
+        items = [
+            {**item, "link": self.base_url + item["link"]}
+            for item in self.search_results[topic]
+        ]
+        return web.json_response({"items": items})
+
+    async def page(self, request: web.Request) -> web.Response:
+        if self.page_latency:
+            await asyncio.sleep(self.page_latency)
+        path = FIXTURES / "pages" / request.match_info["name"]
+        if not path.is_file():
+            raise web.HTTPNotFound()
+        return web.Response(text=path.read_text(), content_type="text/html")
+
+    def topic_for(self, query: str) -> str:
+        """Picks the topic whose results share the most words with the query."""
+
+        words = set(query.lower().split())
+
+        def overlap(topic):
+            text = " ".join(
+                f"{item['title']} {item['snippet']}"
+                for item in self.search_results[topic]
+            )
+            return len(words & set(text.lower().split()))
+
+        return max(self.search_results, key=overlap)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_get("/search", self.search)
+        app.router.add_get("/pages/{name}", self.page)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        sockets = site._server.sockets  # type: ignore
+        self.base_url = "http://%s:%d" % sockets[0].getsockname()[:2]
+        return self.base_url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
@@ -0,0 +1,113 @@
+# Prueba de carga HTTP del orquestador desplegado: abre clientes SSE concurrentes contra /streamingSearch y reporta el tiempo hasta el
+# primer evento, hasta el primer token y hasta el final de la respuesta, junto al throughput. Para ver cómo escala con los núcleos se
+# repite con distintos WEB_CONCURRENCY, con la caché ya caliente para que las APIs externas no sean el cuello de botella:
+#
+#   WEB_CONCURRENCY=1 docker compose -f docker-compose.yml -f docker-compose.prod.yml up -d orchestrator
+#   python -m benchmark.http_load --url http://localhost:8000 --concurrency 8 32 64 --label 1-worker
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+import numpy as np
+
+from benchmark.fakes import FIXTURES
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="SSE load test of the orchestrator.")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--warmup", action="store_true", help="Send every query once before measuring."
+    )
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--label", default="", help="Tag of the run, e.g. 4-workers.")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    return parser.parse_args()
+
+
+async def stream(session: aiohttp.ClientSession, url: str, query: str) -> dict:
+    """Reads one SSE response, timing its first event, first token and end."""
+
+    start = time.perf_counter()
+    timings = {"first_event": None, "first_token": None}
+    async with session.get(
+        f"{url}/streamingSearch", params={"query": query}
+    ) as response:
+        response.raise_for_status()
+        async for line in response.content:
+            if not line.startswith(b"event:"):
+                continue
+            now = time.perf_counter() - start
+            if timings["first_event"] is None:
+                timings["first_event"] = now
+            if line.strip() == b"event: token" and timings["first_token"] is None:
+                timings["first_token"] = now
+    return {**timings, "total": time.perf_counter() - start}
+
+
+async def run_level(session, url, queries, concurrency, requests) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    results, errors = [], 0
+
+    async def limited(i):
+        nonlocal errors
+        async with semaphore:
+            try:
+                results.append(await stream(session, url, queries[i % len(queries)]))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[limited(i) for i in range(requests)])
+    elapsed = time.perf_counter() - start
+
+    report = {"concurrency": concurrency, "requests": requests, "errors": errors}
+    for name in ("first_event", "first_token", "total"):
+        values = [r[name] for r in results if r[name] is not None]
+        if values:
+            report[f"{name}_p50"], report[f"{name}_p99"] = np.percentile(
+                values, [50, 99]
+            )
+    report["throughput"] = len(results) / elapsed
+    return report
+
+
+async def main(args):
+    queries = [
+        item["query"] for item in json.loads((FIXTURES / "queries.json").read_text())
+    ]
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        if args.warmup:
+            await run_level(session, args.url, queries, len(queries), len(queries))
+        report = [
+            await run_level(session, args.url, queries, concurrency, args.requests)
+            for concurrency in args.concurrency
+        ]
+
+    if args.json:
+        print(json.dumps([{"label": args.label, **row} for row in report], indent=2))
+        return
+
+    print(
+        f"{'label':>10} {'conc':>4} {'errs':>4} {'first ev':>9} {'1st tok':>9} "
+        f"{'total p50':>9} {'total p99':>9} {'req/s':>7}"
+    )
+    for row in report:
+        print(
+            f"{args.label:>10} {row['concurrency']:>4} {row['errors']:>4} "
+            f"{row.get('first_event_p50', float('nan')) * 1000:>7.0f}ms "
+            f"{row.get('first_token_p50', float('nan')) * 1000:>7.0f}ms "
+            f"{row.get('total_p50', float('nan')) * 1000:>7.0f}ms "
+            f"{row.get('total_p99', float('nan')) * 1000:>7.0f}ms "
+            f"{row['throughput']:>7.1f}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
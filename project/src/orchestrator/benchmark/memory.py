@@ -0,0 +1,126 @@
+# Mide la memoria y las asignaciones por request del camino caliente de la recuperación: el ranking y la escritura de los chunks de
+# una request con la representación pydantic (Document con list[float]) frente a la compacta (Chunk con float32).
+#
+#   python -m benchmark.memory --chunks 300 --dimension 1536
+import argparse
+import gc
+import time
+import tracemalloc
+from typing import Any
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics.pairwise import cosine_similarity
+
+from models.chunk import Chunk
+from models.document import Document
+
+
+def document_path(query_vector, texts, embeddings, k) -> list[dict[str, Any]]:
+    """Ranking and Redis payloads as they were built with Document."""
+
+    documents = [
+        {"text": text, "url": "https://example.com", "vector": vector}
+        for text, vector in zip(texts, embeddings)
+    ]
+    query = np.array(query_vector).reshape(1, -1)
+    df: Any = pd.DataFrame(documents)
+    df["vector"] = df["vector"].apply(lambda x: np.array(x).reshape(1, -1))
+    df["similarity"] = df["vector"].apply(
+        lambda row: cosine_similarity(query, row)[0][0]
+    )
+    similar = df.nlargest(k, "similarity")[["text", "url", "vector", "similarity"]]
+    similar["vector"] = similar["vector"].apply(lambda x: x[0].tolist())
+    relevant = [Document(**doc) for doc in similar.to_dict("records")]
+    return [doc.model_dump() for doc in relevant]
+
+
+def chunk_path(query_vector, texts, embeddings, k) -> list[dict[str, Any]]:
+    """Ranking and Redis payloads built with Chunk rows of one float32 matrix."""
+
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    chunks = [
+        Chunk(text, "https://example.com", row) for text, row in zip(texts, matrix)
+    ]
+    query = np.asarray(query_vector, dtype=np.float32)
+    scores = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query))
+    top = np.argpartition(-scores, k - 1)[:k]
+    relevant = [chunks[i].with_similarity(float(scores[i])) for i in top]
+    return [
+        {"text": c.text, "url": c.url, "vector": c.vector.tolist(), "similarity": -1}
+        for c in relevant
+    ]
+
+
+def retained(build, count, dimension) -> int:
+    """Bytes still held by count chunks once the embeddings response is released."""
+
+    vectors = np.random.default_rng(0).normal(size=(count, dimension))
+    gc.collect()
+    tracemalloc.start()
+    # The response is parsed inside the trace: its boxed floats are what Document keeps.
+    embeddings = vectors.tolist()
+    objects = build(embeddings)
+    del embeddings
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+def measure(path, args) -> dict[str, float]:
+    rng = np.random.default_rng(0)
+    texts = [f"chunk {i} " * 40 for i in range(args.chunks)]
+    embeddings = rng.normal(size=(args.chunks, args.dimension)).tolist()
+    query_vector = rng.normal(size=args.dimension).tolist()
+
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    path(query_vector, texts, embeddings, args.k)
+    elapsed = time.perf_counter() - start
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+    return {"peak": peak, "blocks": blocks, "seconds": elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-request memory of the chunks.")
+    parser.add_argument("--chunks", type=int, default=300)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    document_size = retained(
+        lambda embeddings: [
+            Document(text="", url="", vector=vector, similarity=0)
+            for vector in embeddings
+        ],
+        args.chunks,
+        args.dimension,
+    )
+    chunk_size = retained(
+        lambda embeddings: [
+            Chunk("", "", row) for row in np.asarray(embeddings, dtype=np.float32)
+        ],
+        args.chunks,
+        args.dimension,
+    )
+    print(f"{args.chunks} chunks of {args.dimension} dimensions")
+    print(f"Document held: {document_size / args.chunks / 1024:8.1f} KiB per chunk")
+    print(f"Chunk held:    {chunk_size / args.chunks / 1024:8.1f} KiB per chunk")
+
+    for name, path in (("Document", document_path), ("Chunk", chunk_path)):
+        result = measure(path, args)
+        print(
+            f"{name:<9} request peak {result['peak'] / 2**20:7.1f} MiB, "
+            f"{result['blocks']:>7} live blocks, {result['seconds'] * 1000:7.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
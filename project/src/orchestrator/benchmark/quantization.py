@@ -0,0 +1,98 @@
+# Compara recall y memoria por chunk de los vectores de la caché en precisión completa frente a VectorCodec (índice PCA más códigos
+# int8), con y sin reordenar los candidatos con el vector completo de la consulta. No necesita Redis: reproduce la búsqueda con numpy.
+#
+#   python -m benchmark.quantization --chunks 20000 --components 64 128 256 --oversample 4
+import argparse
+import json
+
+import numpy as np
+
+from retrieval.quantization import VectorCodec
+
+
+def embeddings(count: int, dimension: int, latent: int, rng) -> np.ndarray:
+    """Normalized vectors with most of their variance in a latent subspace, like text embeddings."""
+
+    basis = rng.normal(size=(latent, dimension))
+    vectors = rng.normal(size=(count, latent)) @ basis
+    vectors += rng.normal(scale=0.5 * np.sqrt(latent), size=(count, dimension))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def top_k(matrix: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    scores = queries @ matrix.T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def recall(found: np.ndarray, exact: np.ndarray) -> float:
+    hits = sum(len(set(a) & set(b)) for a, b in zip(found, exact))
+    return hits / exact.size
+
+
+def rescored(codec: VectorCodec, codes, scales, candidates, queries, k) -> np.ndarray:
+    results = []
+    for query, rows in zip(queries, candidates):
+        vectors = codec.dequantize(codes[rows], scales[rows])
+        scores = vectors @ query / np.linalg.norm(vectors, axis=1)
+        results.append(rows[np.argsort(-scores)[:k]])
+    return np.array(results)
+
+
+def stored_bytes(payload: dict, index_dimension: int) -> int:
+    """Serialized vector fields of a chunk plus the float32 copy kept by the index."""
+
+    return len(json.dumps(payload)) + 4 * index_dimension
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall against memory of VectorCodec.")
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--latent", type=int, default=96)
+    parser.add_argument("--components", type=int, nargs="+", default=[64, 128, 256])
+    parser.add_argument("--oversample", type=int, default=4)
+    parser.add_argument("--fit-sample", type=int, default=5000)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    matrix = embeddings(args.chunks, args.dimension, args.latent, rng)
+    # Queries are close to cached chunks, as the lookups that the cache answers.
+    queries = matrix[rng.choice(args.chunks, args.queries, replace=False)]
+    queries = queries + rng.normal(scale=0.02, size=queries.shape).astype(np.float32)
+    exact = top_k(matrix, queries, args.k)
+
+    sample = matrix[rng.choice(args.chunks, args.fit_sample, replace=False)]
+    full_size = stored_bytes({"vector": matrix[0].tolist()}, args.dimension)
+    print(f"{args.chunks} chunks of {args.dimension} dimensions, recall@{args.k}")
+    print(f"{'variant':<24} {'bytes/chunk':>12} {'ratio':>6} {'recall':>7}")
+    print(f"{'float32':<24} {full_size:>12} {1:>6.1f} {1:>7.3f}")
+
+    codes, scales = VectorCodec.quantize(matrix)
+    for n_components in args.components:
+        codec = VectorCodec.fit(sample, n_components)
+        projected = codec.project(matrix)
+        size = stored_bytes(
+            {"vector": projected[0].tolist(), "codes": codec.encode(matrix[0])},
+            n_components,
+        )
+
+        index_only = top_k(projected, codec.project(queries), args.k)
+        candidates = top_k(projected, codec.project(queries), args.k * args.oversample)
+        rescore = rescored(codec, codes, scales, candidates, queries, args.k)
+
+        for name, found in (
+            (f"pca{n_components}", index_only),
+            (f"pca{n_components}+int8 x{args.oversample}", rescore),
+        ):
+            print(
+                f"{name:<24} {size:>12} {full_size / size:>6.1f} "
+                f"{recall(found, exact):>7.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
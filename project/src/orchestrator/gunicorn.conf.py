@@ -0,0 +1,36 @@
+# Modo producción del orquestador: varios workers de uvicorn bajo gunicorn, sin --reload.
+#
+#   gunicorn -c gunicorn.conf.py main:app
+#
+# La app no se precarga: cada worker importa main por su cuenta y crea sus propios pools de Redis, sesiones HTTP, el modelo de
+# spaCy y el nivel caliente de la caché. Cada worker escribe sus métricas en METRICS_DIR y /metrics
+# responde la suma de todos, atienda quien atienda la request.
+import multiprocessing
+import os
+import shutil
+
+bind = os.environ.get("BIND", "0.0.0.0:80")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = False
+
+# Las respuestas SSE duran lo que tarda el pipeline completo y el streaming del LLM.
+timeout = int(os.environ.get("WORKER_TIMEOUT", 120))
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+
+# Reiniciar los workers de vez en cuando acota la memoria que acumulan; el jitter evita que lo hagan todos a la vez.
+max_requests = int(os.environ.get("MAX_REQUESTS", 5000))
+max_requests_jitter = int(os.environ.get("MAX_REQUESTS_JITTER", 500))
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.environ.get("LOG_LEVEL", "info")
+
+# Los contadores de los workers reiniciados siguen sumando; el directorio se vacía solo al arrancar el master.
+METRICS_DIR = os.environ.setdefault("METRICS_DIR", "/tmp/orchestrator-metrics")
+
+
+def on_starting(server):
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    os.makedirs(METRICS_DIR)
@@ -0,0 +1,276 @@
+# Precarga de la caché de chunks: recorre una lista de URLs o de consultas (una por línea) por el pipeline scrape → split → embed →
+# write con concurrencia acotada y escrituras a Redis en lotes de tamaño fijo. Cada elemento terminado se anota en un checkpoint, de
+# modo que una ejecución interrumpida continúa donde quedó.
+#
+#   python ingest.py --urls urls.txt --checkpoint urls.done
+#   python ingest.py --queries topics.txt --concurrency 4 --batch-size 200
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Iterator, Optional
+
+from models.chunk import Chunk
+from retrieval import Retriever
+from retrieval.cache import RedisVectorCache
+from retrieval.embeddings import OpenAIEmbeddings
+from retrieval.retention import RetentionPolicy
+from retrieval.scheduler import ScrapeScheduler
+from retrieval.scraper import ScraperLocal
+from retrieval.search import GoogleAPI
+from retrieval.splitter import LangChainSplitter
+from util import logger
+from util.logger import setup_logging
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Bulk ingestion into the chunk cache.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--urls", help="File with one URL per line, - for stdin.")
+    source.add_argument("--queries", help="File with one query per line, - for stdin.")
+    parser.add_argument(
+        "--checkpoint", default=None, help="Defaults to the input file plus .done."
+    )
+    parser.add_argument("--retry-failed", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--redis-host", default="cache")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--report-every", type=float, default=10.0)
+    return parser.parse_args()
+
+
+def read_lines(path: str) -> Iterator[str]:
+    """Yields the non empty lines of the file lazily."""
+
+    lines = sys.stdin if path == "-" else open(path)
+    try:
+        for line in lines:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+
+class Checkpoint:
+    """Append-only log of the finished items with their status."""
+
+    def __init__(self, path: Optional[str]) -> None:
+        self.path = path
+        self.done: dict[str, str] = {}
+        if path is None or not os.path.exists(path):
+            return
+        with open(path) as log:
+            for line in log:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A run killed while writing leaves a truncated last line.
+                    continue
+                self.done[entry["item"]] = entry["status"]
+
+    def skip(self, item: str, retry_failed: bool) -> bool:
+        status = self.done.get(item)
+        return status == "ok" or (status is not None and not retry_failed)
+
+    def mark(self, entries: list[tuple[str, str]]):
+        if self.path is None or not entries:
+            return
+        with open(self.path, "a") as log:
+            log.write(
+                "".join(
+                    json.dumps({"item": item, "status": status}) + "\n"
+                    for item, status in entries
+                )
+            )
+        self.done.update(entries)
+
+
+class Ingestor:
+    """Runs the items through the retriever stages and writes the chunks in batches.
+
+    An item is checkpointed only after all of its chunks were written, so a
+    crash can at worst ingest an item twice, which the cache deduplicates.
+    """
+
+    def __init__(
+        self,
+        retriever: Retriever,
+        checkpoint: Checkpoint,
+        concurrency: int = 8,
+        batch_size: int = 100,
+    ) -> None:
+        self.retriever = retriever
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._buffer: list[Chunk] = []
+        self._buffered_items: list[tuple[str, str]] = []
+        self._write_lock = asyncio.Lock()
+        self.pages = 0
+        self.chunks = 0
+        self.failed = 0
+        self.start = time.perf_counter()
+
+    async def pages_of(self, item: str, queries: bool) -> list[dict]:
+        if not queries:
+            return [await self.retriever.scraper.fetch(item)]
+
+        results = await self.retriever.searcher.run(item)
+        return [page async for page in self.retriever.scrape_pages(results)]
+
+    async def ingest(self, item: str, queries: bool):
+        try:
+            pages = await self.pages_of(item, queries)
+            chunks = await self.retriever.embed_pages(pages)
+        except Exception as e:
+            logger.info("Ingest failed", extra={"item": item, "error": e})
+            self.failed += 1
+            await self.buffer(item, "failed", [])
+            return
+
+        self.pages += sum(1 for page in pages if page["text"])
+        await self.buffer(item, "ok" if chunks else "empty", chunks)
+
+    async def buffer(self, item: str, status: str, chunks: list[Chunk]):
+        self._buffer.extend(chunks)
+        self._buffered_items.append((item, status))
+        if len(self._buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        """Writes the buffered chunks in batches, then checkpoints their items."""
+
+        async with self._write_lock:
+            chunks, self._buffer = self._buffer, []
+            items, self._buffered_items = self._buffered_items, []
+            for i in range(0, len(chunks), self.batch_size):
+                await self.retriever.cache.write(chunks[i : i + self.batch_size])
+            self.chunks += len(chunks)
+            self.checkpoint.mark(items)
+
+    async def run(
+        self,
+        items: Iterator[str],
+        queries: bool = False,
+        retry_failed: bool = False,
+        report_every: float = 10.0,
+    ):
+        # The queue keeps at most a few items per worker in memory.
+        queue: asyncio.Queue[Optional[str]] = asyncio.Queue(
+            maxsize=2 * self.concurrency
+        )
+
+        async def worker():
+            while (item := await queue.get()) is not None:
+                await self.ingest(item, queries)
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(report_every)
+                self.report()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        reporting = asyncio.create_task(reporter())
+
+        async def put(item: Optional[str]):
+            # A worker only dies when a write fails, e.g. Redis is down; waiting
+            # for room in the queue would then block forever, so its error is raised.
+            putting = asyncio.ensure_future(queue.put(item))
+            while not putting.done():
+                running = [task for task in workers if not task.done()]
+                await asyncio.wait(
+                    [putting, *running], return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in workers:
+                    if task.done() and not task.cancelled() and task.exception():
+                        putting.cancel()
+                        raise task.exception()  # type: ignore
+
+        failed = False
+        try:
+            for item in items:
+                if not self.checkpoint.skip(item, retry_failed):
+                    await put(item)
+            for _ in workers:
+                await put(None)
+            await asyncio.gather(*workers)
+        except Exception as e:
+            failed = True
+            logger.error("Ingest stopped", extra={"error": e})
+            raise
+        finally:
+            reporting.cancel()
+            for task in workers:
+                task.cancel()
+            # After a failed write the buffered chunks are not retried; their items
+            # are not checkpointed, so the next run ingests them again.
+            if not failed:
+                await self.flush()
+        self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        logger.info(
+            "Ingested",
+            extra={
+                "pages": self.pages,
+                "chunks": self.chunks,
+                "failed": self.failed,
+                "duration": elapsed,
+                "docs_per_second": self.pages / elapsed,
+                "chunks_per_second": self.chunks / elapsed,
+            },
+        )
+
+
+async def main(args):
+    path = args.urls or args.queries
+    checkpoint_path = args.checkpoint
+    if checkpoint_path is None and path != "-":
+        checkpoint_path = path + ".done"
+
+    # Los chunks ingeridos viven y cuentan para el tope igual que los que escribe el orquestador.
+    cache = RedisVectorCache(
+        host=args.redis_host,
+        port=args.redis_port,
+        retention=RetentionPolicy.from_env(),
+    )
+    cache.codec = (
+        cache.load_codec() if os.environ.get("VECTOR_CODEC") == "pca" else None
+    )
+    try:
+        cache.init_index(vector_dimension=OpenAIEmbeddings.vector_dimension)
+    except Exception as e:
+        logger.info("Index already exists: %s", e)
+
+    retriever = Retriever(
+        cache=cache,
+        searcher=GoogleAPI(),
+        scraper=ScrapeScheduler(ScraperLocal(), deadline=None),
+        embeddings=OpenAIEmbeddings(),
+        splitter=LangChainSplitter(
+            chunk_size=400, chunk_overlap=50, length_function=len
+        ),
+    )
+    ingestor = Ingestor(
+        retriever,
+        Checkpoint(checkpoint_path),
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+    )
+    await ingestor.run(
+        read_lines(path),
+        queries=args.queries is not None,
+        retry_failed=args.retry_failed,
+        report_every=args.report_every,
+    )
+
+
+if __name__ == "__main__":
+    setup_logging()
+    asyncio.run(main(parse_args()))
@@ -1,85 +1,314 @@
+import asyncio
+from contextlib import aclosing
+import logging
+import os
+import time
 from typing import AsyncGenerator
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
 from sse_starlette.sse import EventSourceResponse
-from util import logger
+from starlette.background import BackgroundTask
+from util import logger, metrics
+from util.admission import AdmissionController, Rejected, Ticket
+from util.coalescer import TokenCoalescer
+from util.logger import setup_logging
+from util.metrics import LogExporter
 
 import prompt
 import openai
+from models.answer import Answer
 from retrieval import Retriever
+from retrieval.retriever import background_fills
 from retrieval.search import GoogleAPI
-from retrieval.cache import RedisVectorCache
+from retrieval.cache import RedisAnswerCache, RedisVectorCache, VectorDbCache
+from retrieval.local_cache import LocalVectorCache
 from retrieval.scraper import ScraperLocal, ScraperRemote
 from retrieval.embeddings import OpenAIEmbeddings, RemoteEmbeddings
+from retrieval.packer import ContextPacker
 from retrieval.splitter import LangChainSplitter
+from retrieval.retention import RetentionPolicy
+from retrieval.scheduler import ScrapeScheduler
+from retrieval.tiered_cache import TieredVectorCache
 
 
-# # setup loggers
-# logging.config.fileConfig("logging.conf", disable_existing_loggers=False)  # type: ignore
-# logger = logging.getLogger(__name__)
+# Los logs del orquestador y el access log de uvicorn se escriben desde un hilo aparte, fuera del event loop.
+setup_logging(access_log=logging.getLogger("uvicorn.access"))
 app = FastAPI()
 
+# Segundos entre los pings que mantienen viva la conexión SSE mientras el pipeline trabaja.
+SSE_PING_INTERVAL = int(os.environ.get("SSE_PING_INTERVAL", 15))
+# Los tokens del LLM se agrupan en un evento cada TOKEN_FLUSH_INTERVAL segundos o TOKEN_FLUSH_BYTES bytes; con 0 se envía cada token.
+TOKEN_FLUSH_INTERVAL = float(os.environ.get("TOKEN_FLUSH_INTERVAL", 0.05))
+TOKEN_FLUSH_BYTES = int(os.environ.get("TOKEN_FLUSH_BYTES", 256))
+# Con CONTEXT_MODE=snippets un fallo de caché responde desde los snippets de Google mientras las páginas se raspan en segundo plano.
+SNIPPET_FIRST = os.environ.get("CONTEXT_MODE", "full") == "snippets"
+# Rellenos de la caché en segundo plano a la vez por worker; por encima de este número los nuevos se descartan.
+MAX_BACKGROUND_FILLS = int(os.environ.get("MAX_BACKGROUND_FILLS", 16))
+# Con METRICS_DIR cada worker deja sus métricas en ese directorio y /metrics responde la suma de todos los workers.
+METRICS_DIR = os.environ.get("METRICS_DIR")
+if METRICS_DIR:
+    metrics.share(METRICS_DIR)
 
-def stream_chat(prompt: str):
+# TTL de los chunks por dominio, renovado con los hits, y tope opcional de chunks en Redis.
+retention = RetentionPolicy.from_env()
+
+# Con VECTOR_CACHE=local los chunks viven en una matriz dentro de cada worker en lugar de en Redis; con LOCAL_CACHE_PATH la matriz
+# se mapea a ese directorio y sobrevive a los reinicios, por lo que entonces debe correr un solo worker (WEB_CONCURRENCY=1).
+LOCAL_VECTOR_CACHE = os.environ.get("VECTOR_CACHE", "redis") == "local"
+
+# Nivel caliente en proceso delante de Redis, compartido por todas las requests.
+redis_cache = RedisVectorCache(host="cache", port=6379, retention=retention)
+chunk_cache: VectorDbCache
+if LOCAL_VECTOR_CACHE:
+    chunk_cache = LocalVectorCache(
+        OpenAIEmbeddings.vector_dimension,
+        path=os.environ.get("LOCAL_CACHE_PATH"),
+        ttl=retention.ttl,
+    )
+else:
+    chunk_cache = TieredVectorCache(
+        remote=redis_cache,
+        max_items=int(os.environ.get("HOT_TIER_SIZE", 2048)),
+        confidence=float(os.environ.get("HOT_TIER_CONFIDENCE", 0.9)),
+    )
+
+answer_cache = RedisAnswerCache(host="cache", port=6379, treshold=0.97, ttl=3600)
+
+# Planificador de raspado compartido: limita sockets por host y corta los dominios que fallan para todas las requests.
+# Con SCRAPER=remote se raspa a través de las réplicas de scraper detrás de lb-scraper.
+scraper_backend = (
+    ScraperRemote() if os.environ.get("SCRAPER", "local") == "remote" else ScraperLocal()
+)
+scrape_scheduler = ScrapeScheduler(
+    scraper_backend,
+    max_concurrency=int(os.environ.get("SCRAPE_MAX_CONCURRENCY", 64)),
+    per_host=int(os.environ.get("SCRAPE_PER_HOST", 4)),
+    deadline=float(os.environ.get("SCRAPE_DEADLINE", 8)),
+)
+
+# Presupuesto de tokens del contexto: se descartan los chunks casi duplicados y el solapamiento del splitter antes de llenarlo.
+# CONTEXT_DIVERSITY va de 0, solo relevancia, a 1, solo chunks distintos de los ya elegidos.
+context_packer = ContextPacker(
+    max_tokens=int(os.environ.get("CONTEXT_MAX_TOKENS", 1000)),
+    diversity=float(os.environ.get("CONTEXT_DIVERSITY", 0.3)),
+    max_overlap=50,
+)
+
+# Control de admisión por worker: requests simultáneas, cola acotada y límites por etapa. Bajo presión se responde solo desde la caché.
+admission = AdmissionController(
+    max_requests=int(os.environ.get("ADMISSION_MAX_REQUESTS", 32)),
+    max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", 64)),
+    max_wait=float(os.environ.get("ADMISSION_MAX_WAIT", 5)),
+    degrade_at=float(os.environ.get("ADMISSION_DEGRADE_AT", 0.75)),
+    stage_limits=AdmissionController.parse_limits(
+        os.environ.get("ADMISSION_STAGE_LIMITS", "embedding=16,scrape=8,llm=16")
+    ),
+)
+
+# Los spans se descartan salvo que TRACE_EXPORTER=log, las métricas se mantienen siempre.
+if os.environ.get("TRACE_EXPORTER", "none") == "log":
+    metrics.exporter = LogExporter(logger)
+
+
+@app.on_event("startup")
+def load_vector_codec():
+    # Con VECTOR_CODEC=pca los chunks se guardan con el codec ajustado por RedisVectorCache.fit_codec.
+    if os.environ.get("VECTOR_CODEC", "none") != "pca" or LOCAL_VECTOR_CACHE:
+        return
+    try:
+        redis_cache.codec = redis_cache.load_codec()
+    except Exception as e:
+        logger.info("Chunks will be stored in full precision: %s", e)
+        return
+    if redis_cache.codec is None:
+        logger.info("No vector codec fitted yet, chunks are stored in full precision")
+
+
+@app.on_event("startup")
+def create_indexes():
+    # Cada worker lo intenta al arrancar, en lugar de en cada request; el primero crea los índices.
+    vector_dimension = OpenAIEmbeddings.vector_dimension
+    # redis_cache.init_test()
+    try:
+        if not LOCAL_VECTOR_CACHE:
+            redis_cache.init_index(vector_dimension=vector_dimension)
+            logger.info("Created index with vector dimensions %d", vector_dimension)
+    except Exception:
+        logger.info("Index already exists.")
+
+    try:
+        answer_cache.init_index(vector_dimension=vector_dimension)
+    except Exception:
+        logger.info("Answer index already exists.")
+
+
+@app.on_event("shutdown")
+async def finish_background_fills():
+    if background_fills:
+        await asyncio.wait(background_fills, timeout=30)
+
+
+@app.on_event("shutdown")
+async def close_scraper():
+    if isinstance(scraper_backend, ScraperRemote):
+        await scraper_backend.close()
+
+
+@app.on_event("startup")
+def start_retention_flusher():
+    # Los hits acumulados se envían cada flush_interval aunque no lleguen más requests.
+    if not LOCAL_VECTOR_CACHE:
+        retention.start_flusher(redis_cache.client)
+
+
+@app.on_event("shutdown")
+def flush_retention():
+    if isinstance(chunk_cache, LocalVectorCache):
+        chunk_cache.flush()
+        return
+    try:
+        retention.close(redis_cache.client)
+    except Exception as e:
+        logger.info("Pending chunk hits were not flushed: %s", e)
+
+
+@app.on_event("startup")
+def listen_cache_expirations():
+    if not isinstance(chunk_cache, TieredVectorCache):
+        return
+    try:
+        redis_cache.listen_expired(chunk_cache.invalidate)
+    except Exception as e:
+        logger.info("Hot tier will rely on its own TTL: %s", e)
+
+
+async def stream_chat(prompt: str) -> AsyncGenerator[str, None]:
     """
 La función stream_chat utiliza el modelo GPT-3.5-turbo de OpenAI para generar respuestas de chat de manera continua basándose en un aviso dado.
 prompt: La función stream_chat toma un aviso como entrada y utiliza el modelo GPT-3.5 de OpenAI para generar respuestas de chat basadas en el 
-aviso. La función transmite las respuestas del chat a medida que se generan.
+aviso. La función transmite las respuestas del chat a medida que se generan. La petición es asíncrona: no bloquea el event loop
+entre tokens y, si el cliente se desconecta, cerrar el generador corta la conexión con OpenAI en lugar de consumir la respuesta entera.
 type prompt: str
     """
-    for chunk in openai.ChatCompletion.create(
+    response = await openai.ChatCompletion.acreate(
         model="gpt-3.5-turbo",
         temperature=0.0,
         messages=[{"role": "user", "content": prompt}],
         stream=True,
-    ):
-        content = chunk["choices"][0].get("delta", {}).get("content")  # type: ignore
-        if content is not None:
-            yield content
+    )
+    try:
+        async for chunk in response:  # type: ignore
+            content = chunk["choices"][0].get("delta", {}).get("content")
+            if content is not None:
+                yield content
+    finally:
+        await response.aclose()  # type: ignore
 
 
-async def event_generator(query) -> AsyncGenerator[dict, None]:
+async def event_generator(query, degraded: bool = False) -> AsyncGenerator[dict, None]:
     """
 La función event_generator inicializa varios componentes como la caché de Redis, embeddings, la API de Google, el scraper y el splitter, y 
 luego crea un objeto retriever para un procesamiento adicional.
 query: La función event_generator parece estar configurando varios componentes como RedisVectorCache, OpenAIEmbeddings, GoogleAPI, ScraperLocal y 
 LangChainSplitter para crear una instancia de Retriever para manejar eventos basados en una consulta dada.
     """
-    redis = RedisVectorCache(host="cache", port=6379)
+    answers = answer_cache
     embeddings = OpenAIEmbeddings()
     google = GoogleAPI()
-    scraper = ScraperLocal()
+    scraper = scrape_scheduler
     splitter = LangChainSplitter(chunk_size=400, chunk_overlap=50, length_function=len)
 
     # scraper = ScraperRemoteClient()
     # embeddings = RemoteEmbeddings()
 
-    # redis.init_test()
-    try:
-        redis.init_index(vector_dimension=embeddings.vector_dimension)
-        logger.info(
-            f"Created index with vector dimensions {embeddings.vector_dimension}"
-        )
-    except:
-        logger.info("Index already exists.")
-
     retriever = Retriever(
-        cache=redis,
+        cache=chunk_cache,
         searcher=google,
         scraper=scraper,
         embeddings=embeddings,
         splitter=splitter,
+        packer=context_packer,
+        admission=admission,
+        max_background_fills=MAX_BACKGROUND_FILLS,
     )
 
+    # Every log line of the request carries this trace id.
+    metrics.start_trace()
+    logger.debug("Request started", extra={"degraded": degraded})
+
+    with metrics.span("query_embedding") as span:
+        async with admission.stage("embedding"):
+            query_vector = (await embeddings.run([query]))[0]
+    yield retriever.progress_event("query_embedded", seconds=span.duration)
+    if degraded:
+        yield retriever.progress_event("degraded", mode="cache_only")
+
+    with metrics.span("answer_cache_lookup"):
+        answer = await answers.find(query_vector)
+    if answer is not None:
+        logger.info(
+            "Answer cache hit",
+            extra={"stage": "answer_cache_lookup", "similarity": answer.similarity},
+        )
+        yield {"event": "search", "data": answer.search}
+        yield {"event": "context", "data": answer.context}
+        final_prompt = prompt.rag.format(context=answer.context, question=query)
+        yield {"event": "prompt", "data": final_prompt}
+        # The whole answer is known, it is sent in a single event.
+        yield {"event": "token", "data": "".join(answer.tokens)}
+        return
+
 # Este bloque de código es parte de una función generadora de eventos asincrónica en Python. Aquí tienes un desglose de lo que hace:
-    async for event in retriever.get_context(query=query, cache_treshold=0.85, k=10):
+    search, context, tokens = "", "", []
+    provisional = False
+    async for event in retriever.get_context(
+        query=query,
+        cache_treshold=0.85,
+        k=10,
+        doc_treshold=0.85,
+        query_vector=query_vector,
+        snippet_first=SNIPPET_FIRST and not degraded,
+        cache_only=degraded,
+    ):
         yield event
-        if event["event"] == "context":
-            final_prompt = prompt.rag.format(context=event["data"], question=query)
+        if event["event"] == "search":
+            search = event["data"]
+        if event["event"] in ("context", "snippet_context"):
+            # Answers from snippets or degraded to the cache are not cached, a later query will do better.
+            provisional = event["event"] == "snippet_context" or degraded
+            context = event["data"]
+            final_prompt = prompt.rag.format(context=context, question=query)
 
             yield {"event": "prompt", "data": final_prompt}
 
-            for text in stream_chat(prompt=final_prompt):
-                yield {"event": "token", "data": text}
+            start = time.perf_counter()
+            coalescer = TokenCoalescer(TOKEN_FLUSH_INTERVAL, TOKEN_FLUSH_BYTES)
+            # Closing the stream as soon as the request ends frees the OpenAI connection.
+            async with admission.stage("llm"), aclosing(
+                stream_chat(prompt=final_prompt)
+            ) as chunks, aclosing(coalescer.coalesce(chunks)) as batches:
+                # The first token goes out right away, only the rest is batched.
+                async for text in batches:
+                    if coalescer.tokens == 1:
+                        metrics.histogram(
+                            "llm_time_to_first_token_seconds",
+                            "Time from the prompt to the first streamed token.",
+                        ).observe(time.perf_counter() - start)
+                    tokens.append(text)
+                    yield {"event": "token", "data": text}
+            metrics.record("llm", start, tokens=coalescer.tokens, events=len(tokens))
+
+    if tokens and not provisional:
+        await answers.write(
+            Answer(
+                query=query,
+                search=search,
+                context=context,
+                tokens=tokens,
+                vector=query_vector,
+                similarity=-1,
+            )
+        )
 
 
     """
@@ -94,8 +323,53 @@ cliente accede a este endpoint, devolverá un objeto EventSourceResponse generad
 proporcionado.
     """
 @app.get("/streamingSearch")
-async def main(query: str) -> EventSourceResponse:
-    return EventSourceResponse(event_generator(query))
+async def main(query: str):
+    try:
+        ticket = await admission.admit()
+    except Rejected as e:
+        return JSONResponse(
+            {"detail": "Orchestrator busy", "reason": e.reason},
+            status_code=e.status,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    # The slot is released when the events end or fail, and by the background
+    # task in case the stream never started; releasing twice is a no-op.
+    return EventSourceResponse(
+        admitted(ticket, event_generator(query, ticket.degraded)),
+        ping=SSE_PING_INTERVAL,
+        background=BackgroundTask(ticket.release),
+    )
+
+
+async def admitted(ticket: Ticket, events: AsyncGenerator[dict, None]):
+    """Streams the events holding the admission slot.
+
+    When the client disconnects sse-starlette cancels the stream, or drops it
+    while it waits at a yield; either way the pipeline is closed right away so
+    that the scrapes, embeddings and LLM stream in flight are cancelled.
+    """
+
+    stage = "start"
+    try:
+        async for event in events:
+            stage = event["event"]
+            yield event
+    except (asyncio.CancelledError, GeneratorExit):
+        metrics.counter(
+            "client_disconnects_total", "Streams closed by the client by last event."
+        ).inc(stage=stage)
+        raise
+    finally:
+        ticket.release()
+        await events.aclose()
+
+
+@app.get("/metrics")
+async def get_metrics() -> PlainTextResponse:
+    """Exposes the pipeline metrics in the Prometheus text format."""
+
+    text = metrics.render_shared(METRICS_DIR) if METRICS_DIR else metrics.render()
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,10 @@
+from pydantic import BaseModel
+
+
+class Answer(BaseModel):
+    query: str
+    search: str
+    context: str
+    tokens: list[str]
+    vector: list[float]
+    similarity: float
@@ -0,0 +1,28 @@
+# La clase Chunk es la representación compacta de un fragmento en el camino caliente de la recuperación: sin validación de pydantic
+# y con el vector como float32 de NumPy, normalmente una fila de la matriz compartida de los embeddings de la request.
+from typing import Optional
+
+import numpy as np
+
+
+class Chunk:
+    __slots__ = ("text", "url", "vector", "similarity", "key")
+
+    def __init__(
+        self,
+        text: str,
+        url: str,
+        vector: np.ndarray,
+        similarity: float = -1.0,
+        key: Optional[str] = None,
+    ) -> None:
+        self.text = text
+        self.url = url
+        self.vector = np.asarray(vector, dtype=np.float32)
+        self.similarity = similarity
+        self.key = key
+
+    def with_similarity(self, similarity: float) -> "Chunk":
+        """Returns a copy scored for another query, sharing the same vector."""
+
+        return Chunk(self.text, self.url, self.vector, similarity, self.key)
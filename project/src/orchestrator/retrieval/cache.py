@@ -2,6 +2,8 @@
 from abc import ABC, abstractmethod
 import hashlib
 import json
+import os
+from typing import Callable, Optional
 import numpy as np
 import pandas as pd
 import redis
@@ -11,7 +13,11 @@ from redis.commands.search.field import (
 )
 from redis.commands.search.indexDefinition import IndexDefinition, IndexType
 from redis.commands.search.query import Query
-from models.document import Document
+from models.answer import Answer
+from models.chunk import Chunk
+from retrieval.quantization import VectorCodec
+from retrieval.retention import RetentionPolicy
+from util import metrics
 
 VECTOR_DIMENSION = 1536
 
@@ -19,62 +25,139 @@ VECTOR_DIMENSION = 1536
 # vectorial.
 class VectorDbCache(ABC):
     @abstractmethod
-    async def find_similar(self, vector: list[float], k=10) -> list[Document]:
+    async def find_similar(self, vector: list[float], k=10) -> list[Chunk]:
         pass
 
     @abstractmethod
-    async def write(self, documents: list[Document]):
+    async def write(self, documents: list[Chunk]):
         pass
 
+    async def touch(self, documents: list[Chunk]):
+        """Tells the cache that the documents were served, by default nothing is done."""
 
-SHA256 = hashlib.sha256()
+
+CODEC_KEY = "codec:chunks"
 
 
 # La clase RedisVectorCache es una subclase de VectorDbCache que utiliza Redis para la caché e implementa un método para encontrar documentos 
 # similares basados en vectores de entrada.
 class RedisVectorCache(VectorDbCache):
-    _pool = None
+    # One pool per process and server: a pool inherited through fork shares its sockets with the parent.
+    _pools: dict[tuple[int, str, int], redis.ConnectionPool] = {}
 
-    def __init__(self, host, port) -> None:
-        if RedisVectorCache._pool is None:
-            RedisVectorCache._pool = redis.ConnectionPool(host=host, port=port)
+    @classmethod
+    def pool(cls, host, port) -> redis.ConnectionPool:
+        key = (os.getpid(), host, port)
+        if key not in cls._pools:
+            cls._pools[key] = redis.ConnectionPool(host=host, port=port)
+        return cls._pools[key]
 
+    def __init__(
+        self,
+        host,
+        port,
+        codec: Optional[VectorCodec] = None,
+        oversample: int = 4,
+        retention: Optional[RetentionPolicy] = None,
+    ) -> None:
+        """
+    codec: Con un VectorCodec el índice guarda la proyección PCA de los vectores y el documento el vector completo cuantizado a int8.
+    Cada búsqueda pide oversample veces k candidatos al índice y los reordena con el vector completo de la consulta.
+    retention: La RetentionPolicy fija el TTL de cada chunk, lo renueva con los hits y limita cuántos chunks se guardan. Sin ella
+    todos los chunks viven 3600 segundos.
+        """
         self.client = redis.Redis(
-            connection_pool=RedisVectorCache._pool, decode_responses=True
+            connection_pool=RedisVectorCache.pool(host, port), decode_responses=True
         )
+        self.codec = codec
+        self.oversample = oversample
+        self.retention = retention
 
-    async def find_similar(self, vector: list[float], k=10) -> list[Document]:
-        chunks = (
-            self.client.ft("idx:chunks_vss")
-            .search(
-                Query(f"(*)=>[KNN {k} @vector $query_vector AS vector_score]")
-                .sort_by("vector_score")
-                .return_fields("vector_score", "text", "url", "vector")
-                .dialect(2),
-                {"query_vector": np.array(vector, dtype=np.float32).tobytes()},
+    @property
+    def index_name(self) -> str:
+        # Each projection gets its own index, documents of another dimension are not indexed.
+        if self.codec is None:
+            return "idx:chunks_vss"
+        return f"idx:chunks_vss_pca{self.codec.dimension}"
+
+    def _search(self, query_vector: np.ndarray, k: int, *fields: str):
+        with metrics.span("redis_knn", index=self.index_name, k=k):
+            return (
+                self.client.ft(self.index_name)
+                .search(
+                    Query(f"(*)=>[KNN {k} @vector $query_vector AS vector_score]")
+                    .sort_by("vector_score")
+                    .return_fields("vector_score", *fields)
+                    .dialect(2),
+                    {"query_vector": query_vector.astype(np.float32).tobytes()},
+                )
+                .docs  # type: ignore
             )
-            .docs  # type: ignore
-        )
+
+    async def find_similar(self, vector: list[float], k=10) -> list[Chunk]:
+        if self.codec is not None:
+            return self._find_quantized(vector, k)
+
+        chunks = self._search(np.asarray(vector), k, "text", "url", "vector")
         documents = map(
-            lambda doc: Document(
+            lambda doc: Chunk(
                 url=doc.url,
                 text=doc.text,
-                vector=json.loads(doc.vector),
+                vector=np.array(json.loads(doc.vector), dtype=np.float32),
                 similarity=1 - float(doc.vector_score),
+                key=doc.id,
             ),
             chunks,
         )
 
         return list(documents)
 
-    async def get_insertables(self, documents: list[Document]) -> list[Document]:
+    def _find_quantized(self, vector: list[float], k: int) -> list[Chunk]:
+        """Searches the projected index and rescores the candidates on the full vectors."""
+
+        codec: VectorCodec = self.codec  # type: ignore
+        query = np.asarray(vector, dtype=np.float32)
+        candidates = self._search(
+            codec.project(query)[0], k * self.oversample, "text", "url", "codes"
+        )
+        if not candidates:
+            return []
+
+        vectors = np.stack([codec.decode(doc.codes) for doc in candidates])
+        norms = np.linalg.norm(vectors, axis=1) * (np.linalg.norm(query) or 1)
+        norms[norms == 0] = 1
+        scores = vectors @ query / norms
+        top = np.argsort(-scores)[:k]
+        return [
+            Chunk(
+                url=candidates[i].url,
+                text=candidates[i].text,
+                vector=vectors[i],
+                similarity=float(scores[i]),
+                key=candidates[i].id,
+            )
+            for i in top
+        ]
+
+    def _payload(self, text: str, url: str, vector: np.ndarray) -> dict:
+        if self.codec is None:
+            return {"text": text, "url": url, "vector": vector.tolist(), "similarity": -1}
+        return {
+            "text": text,
+            "url": url,
+            "vector": self.codec.project(vector)[0].tolist(),
+            "codes": self.codec.encode(vector),
+            "similarity": -1,
+        }
+
+    async def get_insertables(self, documents: list[Chunk]) -> list[Chunk]:
         """
     Esta función toma una lista de documentos, encuentra documentos similares y devuelve una lista de documentos que se consideran insertables
     basándose en un umbral de similitud.
-    documents: El parámetro documents es una lista de objetos Document que se pasan al método get_insertables. Cada objeto Document probablemente 
+    documents: El parámetro documents es una lista de objetos Chunk que se pasan al método get_insertables. Cada objeto Chunk probablemente 
     contiene información o datos que necesitan ser procesados dentro del método.
-    type documents: list[Document]
-    return: El método get_insertables devuelve una lista de objetos Document que se consideran insertables según ciertas condiciones.
+    type documents: list[Chunk]
+    return: El método get_insertables devuelve una lista de objetos Chunk que se consideran insertables según ciertas condiciones.
         """
         insertables = []
         for document in documents:
@@ -85,40 +168,135 @@ class RedisVectorCache(VectorDbCache):
                 insertables.append(document)
         return insertables
 
-    async def write(self, documents: list[Document]):
+    async def write(self, documents: list[Chunk]):
         """
     La función escribe una lista de documentos en una base de datos Redis utilizando una operación de pipeline específica.
     documents: El método write parece estar escribiendo documentos en una base de datos Redis utilizando un pipeline para mejorar el rendimiento. 
     Calcula un hash SHA256 para el texto de cada documento, establece una clave en Redis con el ID del fragmento, y luego almacena los datos del 
     documento en formato JSON con un tiempo de expiración de 360.
-    type documents: list[Document]
+    type documents: list[Chunk]
         """
-        documents = await self.get_insertables(documents)
+        with metrics.span("redis_dedup", documents=len(documents)):
+            documents = await self.get_insertables(documents)
         pipeline = self.client.pipeline()
         for document in documents:
-            SHA256.update(document.text.encode("utf-8"))
-            chunk_id = SHA256.hexdigest()
+            chunk_id = hashlib.sha256(document.text.encode("utf-8")).hexdigest()
             redis_key = f"chunks:{chunk_id}"
-            document.similarity = -1
-            pipeline.json().set(redis_key, "$", document.model_dump())
-            pipeline.expire(redis_key, 3600)
+            payload = self._payload(document.text, document.url, document.vector)
+            pipeline.json().set(redis_key, "$", payload)
+            if self.retention is None:
+                pipeline.expire(redis_key, 3600)
+            else:
+                self.retention.on_write(pipeline, redis_key, document.url)
 
-        pipeline.execute()
+        with metrics.span("redis_write", documents=len(documents)):
+            pipeline.execute()
+            if self.retention is not None:
+                self.retention.enforce_cap(self.client)
+
+    async def touch(self, documents: list[Chunk]):
+        """Counts a hit on the served chunks, the retention policy applies them in batches."""
 
-    def init_test(self):
+        if self.retention is not None:
+            hits = [(doc.key, doc.url) for doc in documents if doc.key]
+            self.retention.record_hits(self.client, hits)
+
+    def listen_expired(self, callback: Callable[[str], None]):
+        """Calls callback with the key of every chunk that Redis expires, evicts or deletes.
+
+        Deletions include the chunks removed by the cap of the retention policy in
+        any process. Expired and evicted keys are also dropped from the usage
+        scores of the retention policy.
+
+        Keyspace notifications are enabled on the server if they are not already,
+        and the subscription runs in a daemon thread.
         """
-       Esta función lee datos de un archivo pickle, los procesa, calcula un hash SHA256 y almacena los datos en Redis utilizando un pipeline.
+
+        events = self.client.config_get("notify-keyspace-events")
+        flags = str(events.get("notify-keyspace-events", ""))
+        missing = "".join(flag for flag in "Egxe" if flag not in flags)
+        if missing:
+            self.client.config_set("notify-keyspace-events", flags + missing)
+
+        evictions = metrics.counter(
+            "cache_evictions_total", "Chunks removed from Redis by reason."
+        )
+
+        def handler(message):
+            key = message["data"]
+            key = key.decode("utf-8") if isinstance(key, bytes) else key
+            if key.startswith("chunks:"):
+                channel = message["channel"]
+                channel = channel.decode("utf-8") if isinstance(channel, bytes) else channel
+                event = channel.rsplit(":", 1)[-1]
+                # Deleted keys were already counted and untracked by enforce_cap.
+                if event != "del":
+                    evictions.inc(reason=event)
+                    if self.retention is not None:
+                        self.retention.forget(self.client, key)
+                callback(key)
+
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(
+            **{
+                "__keyevent@*__:expired": handler,
+                "__keyevent@*__:evicted": handler,
+                "__keyevent@*__:del": handler,
+            }
+        )
+        return pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def fit_codec(self, n_components: int, sample: int = 5000) -> VectorCodec:
+        """Fits a VectorCodec on up to sample full precision chunks and stores it in Redis.
+
+        The codec is shared by every process through load_codec; the chunks written
+        before it keep their full vectors and are only found by the original index.
+        """
+
+        keys = []
+        for key in self.client.scan_iter("chunks:*", count=1000):
+            keys.append(key)
+            if len(keys) >= sample:
+                break
+
+        pipeline = self.client.pipeline()
+        for key in keys:
+            pipeline.json().get(key, "$.vector")
+        vectors = [
+            result[0]
+            for result in pipeline.execute()
+            if result and len(result[0]) > n_components
+        ]
+
+        codec = VectorCodec.fit(np.asarray(vectors, dtype=np.float32), n_components)
+        self.client.set(CODEC_KEY, codec.dumps())
+        return codec
+
+    def load_codec(self) -> Optional[VectorCodec]:
+        """Returns the codec stored by fit_codec, if there is one."""
+
+        return VectorCodec.loads(self.client.get(CODEC_KEY))  # type: ignore
+
+    def init_test(self, batch_size: int = 500):
+        """
+       Esta función lee datos de un archivo pickle, los procesa, calcula un hash SHA256 y almacena los datos en Redis utilizando un pipeline
+       que se ejecuta cada batch_size chunks.
         """
         df = pd.read_pickle("mocks/database_pickle")
         df["vector"] = df["vector"].apply(lambda x: x.tolist()[0])
         chunks = df.to_dict("records")
 
         pipeline = self.client.pipeline()
-        for chunk in chunks:
-            SHA256.update(chunk["text"].encode("utf-8"))
-            chunk_id = SHA256.hexdigest()
+        for i, chunk in enumerate(chunks, start=1):
+            chunk_id = hashlib.sha256(chunk["text"].encode("utf-8")).hexdigest()
             redis_key = f"chunks:{chunk_id}"
+            if self.codec is not None:
+                chunk.update(
+                    self._payload(chunk["text"], chunk["url"], np.array(chunk["vector"]))
+                )
             pipeline.json().set(redis_key, "$", chunk)
+            if i % batch_size == 0:
+                pipeline.execute()
         pipeline.execute()
 
     def init_index(self, vector_dimension):
@@ -136,13 +314,94 @@ class RedisVectorCache(VectorDbCache):
                 "FLAT",
                 {
                     "TYPE": "FLOAT32",
-                    "DIM": vector_dimension,
+                    "DIM": vector_dimension if self.codec is None else self.codec.dimension,
                     "DISTANCE_METRIC": "COSINE",
                 },
                 as_name="vector",
             ),
         )
         definition = IndexDefinition(prefix=["chunks:"], index_type=IndexType.JSON)
-        self.client.ft("idx:chunks_vss").create_index(
+        self.client.ft(self.index_name).create_index(
+            fields=schema, definition=definition
+        )
+
+
+# La clase AnswerCache define métodos abstractos para recuperar y guardar respuestas completas del RAG a partir del vector de la consulta.
+class AnswerCache(ABC):
+    @abstractmethod
+    async def find(self, vector: list[float]) -> Optional[Answer]:
+        pass
+
+    @abstractmethod
+    async def write(self, answer: Answer):
+        pass
+
+
+# La clase RedisAnswerCache guarda las respuestas generadas en Redis, junto al índice de chunks, y las recupera por similitud de la consulta.
+class RedisAnswerCache(AnswerCache):
+    def __init__(self, host, port, treshold: float = 0.97, ttl: int = 3600) -> None:
+        self.client = redis.Redis(
+            connection_pool=RedisVectorCache.pool(host, port), decode_responses=True
+        )
+        self.treshold = treshold
+        self.ttl = ttl
+
+    async def find(self, vector: list[float]) -> Optional[Answer]:
+        """Returns the cached answer of the most similar query, if it is similar enough."""
+
+        lookups = metrics.counter("answer_cache_lookups_total", "Answer cache lookups.")
+        with metrics.span("redis_knn", index="idx:answers_vss", k=1):
+            answers = (
+                self.client.ft("idx:answers_vss")
+                .search(
+                    Query("(*)=>[KNN 1 @vector $query_vector AS vector_score]")
+                    .sort_by("vector_score")
+                    .return_field("vector_score")
+                    .return_field("$", as_field="answer")
+                    .dialect(2),
+                    {"query_vector": np.array(vector, dtype=np.float32).tobytes()},
+                )
+                .docs  # type: ignore
+            )
+        if not answers or 1 - float(answers[0].vector_score) < self.treshold:
+            lookups.inc(result="miss")
+            return None
+
+        lookups.inc(result="hit")
+        similarity = 1 - float(answers[0].vector_score)
+
+        answer = json.loads(answers[0].answer)
+        answer["similarity"] = similarity
+        return Answer(**answer)
+
+    async def write(self, answer: Answer):
+        """Stores the answer under the hash of its query with a time to live."""
+
+        answer_id = hashlib.sha256(answer.query.encode("utf-8")).hexdigest()
+        redis_key = f"answers:{answer_id}"
+        answer.similarity = -1
+        pipeline = self.client.pipeline()
+        pipeline.json().set(redis_key, "$", answer.model_dump())
+        pipeline.expire(redis_key, self.ttl)
+        pipeline.execute()
+
+    def init_index(self, vector_dimension):
+        """Creates the vector index over the cached answers."""
+
+        schema = (
+            TextField("$.query", no_stem=True, as_name="query"),
+            VectorField(
+                "$.vector",
+                "FLAT",
+                {
+                    "TYPE": "FLOAT32",
+                    "DIM": vector_dimension,
+                    "DISTANCE_METRIC": "COSINE",
+                },
+                as_name="vector",
+            ),
+        )
+        definition = IndexDefinition(prefix=["answers:"], index_type=IndexType.JSON)
+        self.client.ft("idx:answers_vss").create_index(
             fields=schema, definition=definition
         )
@@ -5,6 +5,7 @@ import json
 import aiohttp
 
 import openai
+from util import metrics
 
 
 class Embeddings(ABC):
@@ -24,11 +25,14 @@ class RemoteEmbeddings(Embeddings):
         url = f"http://embeddings/encode"
         headers = {"Content-Type": "application/json"}
         payload = json.dumps({"text": chunks})
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=payload, headers=headers) as response:
-                if response.status == 200:
-                    r = await response.json()
-                    return r["embedding"]
+        with metrics.span("embeddings_request", backend="remote", chunks=len(chunks)):
+            async with aiohttp.ClientSession() as session:
+                async with session.post(
+                    url, data=payload, headers=headers
+                ) as response:
+                    if response.status == 200:
+                        r = await response.json()
+                        return r["embedding"]
         return [[]]
 
 
@@ -40,6 +44,7 @@ class OpenAIEmbeddings(Embeddings):
     async def run(
         self, chunks: list[str], model="text-embedding-ada-002"
     ) -> list[list[float]]:
-        response = await openai.Embedding.acreate(input=chunks, model=model)
+        with metrics.span("embeddings_request", backend="openai", chunks=len(chunks)):
+            response = await openai.Embedding.acreate(input=chunks, model=model)
         vectors = map(lambda x: x["embedding"], response["data"])  # type: ignore
         return list(vectors)
@@ -0,0 +1,256 @@
+# La clase LocalVectorCache implementa VectorDbCache dentro del proceso: los vectores normalizados viven en una matriz float32
+# preasignada, mapeada a disco para persistir y reiniciar rápido, y la búsqueda KNN es un producto matricial vectorizado.
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from models.chunk import Chunk
+from retrieval.cache import VectorDbCache
+from util import metrics
+
+
+class LocalVectorCache(VectorDbCache):
+    """In-process vector cache on a float32 matrix, optionally memory-mapped to disk.
+
+    Rows are written before they are published, so readers only need a snapshot
+    of the arrays and the row count and never take the writer lock. An expiry of
+    zero marks a free row; expired rows are reused by later writes.
+    """
+
+    def __init__(
+        self,
+        vector_dimension: int,
+        path: Optional[str] = None,
+        capacity: int = 1024,
+        ttl: int = 3600,
+        dedup_treshold: float = 0.97,
+    ) -> None:
+        self.vector_dimension = vector_dimension
+        self.path = path
+        self.ttl = ttl
+        self.dedup_treshold = dedup_treshold
+        self._lock = threading.Lock()
+        self._texts: list[Optional[str]] = []
+        self._urls: list[Optional[str]] = []
+        self._size = 0
+
+        if path is None:
+            self._segment = (
+                np.zeros((capacity, vector_dimension), dtype=np.float32),
+                np.zeros(capacity, dtype=np.uint32),
+            )
+        else:
+            os.makedirs(path, exist_ok=True)
+            self._open_segment(capacity)
+            self._load_chunks()
+
+        self._texts.extend([None] * (self.capacity - len(self._texts)))
+        self._urls.extend([None] * (self.capacity - len(self._urls)))
+
+    @property
+    def capacity(self) -> int:
+        return len(self._segment[1])
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)  # type: ignore
+
+    def _open_segment(self, capacity: int):
+        """Maps the vector and expiry files, creating or growing them to capacity."""
+
+        meta_path = self._file("meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            if meta["vector_dimension"] != self.vector_dimension:
+                raise ValueError(
+                    f"Cache at {self.path} stores vectors of dimension "
+                    f"{meta['vector_dimension']}, not {self.vector_dimension}"
+                )
+            row_bytes = self.vector_dimension * 4
+            capacity = max(
+                capacity, os.path.getsize(self._file("vectors.f32")) // row_bytes
+            )
+        else:
+            with open(meta_path, "w") as meta_file:
+                json.dump({"vector_dimension": self.vector_dimension}, meta_file)
+
+        # Both arrays are swapped together so readers never mix segment sizes.
+        self._segment = (
+            self._map("vectors.f32", np.float32, (capacity, self.vector_dimension)),
+            self._map("expires.u32", np.uint32, (capacity,)),
+        )
+
+    def _map(self, name: str, dtype, shape: tuple) -> np.memmap:
+        path = self._file(name)
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(path, "ab") as segment:
+            if segment.tell() < size:
+                segment.truncate(size)
+        return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    def _load_chunks(self):
+        """Rebuilds texts and urls from the chunk log, the last write of a row wins."""
+
+        log_path = self._file("chunks.jsonl")
+        if not os.path.exists(log_path):
+            return
+
+        rows: dict[int, dict] = {}
+        with open(log_path) as log:
+            for line in log:
+                try:
+                    chunk = json.loads(line)
+                except json.JSONDecodeError:
+                    # A write interrupted by a crash leaves a truncated last line.
+                    continue
+                rows[chunk["row"]] = chunk
+
+        self._size = max(rows) + 1 if rows else 0
+        self._texts = [None] * self.capacity
+        self._urls = [None] * self.capacity
+        for row, chunk in rows.items():
+            self._texts[row] = chunk["text"]
+            self._urls[row] = chunk["url"]
+
+        self._compact_log(rows)
+
+    def _compact_log(self, rows: dict[int, dict]):
+        now = time.time()
+        expires = self._segment[1]
+        log_path = self._file("chunks.jsonl")
+        with open(log_path + ".tmp", "w") as log:
+            for row, chunk in rows.items():
+                if expires[row] > now:
+                    log.write(json.dumps(chunk) + "\n")
+        os.replace(log_path + ".tmp", log_path)
+
+    def _grow(self, capacity: int):
+        """Reallocates the segment, readers holding the old arrays keep a valid view."""
+
+        if self.path is None:
+            old_matrix, old_expires = self._segment
+            matrix = np.zeros((capacity, self.vector_dimension), dtype=np.float32)
+            expires = np.zeros(capacity, dtype=np.uint32)
+            matrix[: len(old_matrix)] = old_matrix
+            expires[: len(old_expires)] = old_expires
+            self._segment = (matrix, expires)
+        else:
+            self.flush()
+            self._open_segment(capacity)
+
+        self._texts.extend([None] * (capacity - len(self._texts)))
+        self._urls.extend([None] * (capacity - len(self._urls)))
+
+    def _snapshot(self):
+        # The size is read after the segment: it can only grow, and rows past the
+        # end of an older segment are cut by the slicing.
+        matrix, expires = self._segment
+        size = min(self._size, len(expires))
+        return matrix[:size], expires[:size]
+
+    def _scores(self, vectors: np.ndarray, matrix, expires) -> np.ndarray:
+        scores = vectors @ matrix.T
+        scores[:, expires <= time.time()] = -np.inf
+        return scores
+
+    @staticmethod
+    def _normalize(vectors) -> np.ndarray:
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    async def find_similar(self, vector: list[float], k=10) -> list[Chunk]:
+        with metrics.span("local_knn", k=k):
+            matrix, expires = self._snapshot()
+            scores = self._scores(self._normalize(vector), matrix, expires)[0]
+            if not len(scores):
+                return []
+
+            k = min(k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+
+        return [
+            Chunk(
+                text=self._texts[row],  # type: ignore
+                url=self._urls[row],  # type: ignore
+                vector=np.array(matrix[row]),
+                similarity=float(scores[row]),
+            )
+            for row in top
+            if np.isfinite(scores[row])
+        ]
+
+    def _unique(self, vectors: np.ndarray) -> np.ndarray:
+        """Mask of the vectors not near duplicates of a cached or an earlier one."""
+
+        scores = self._scores(vectors, *self._snapshot())
+        keep = (
+            scores.max(axis=1) < self.dedup_treshold
+            if scores.shape[1]
+            else np.ones(len(vectors), dtype=bool)
+        )
+        pairwise = vectors @ vectors.T
+        for i in range(1, len(vectors)):
+            if keep[i] and (pairwise[i, :i][keep[:i]] >= self.dedup_treshold).any():
+                keep[i] = False
+        return keep
+
+    async def write(self, documents: list[Chunk]):
+        """Appends the documents not near duplicates of a cached or an earlier one."""
+
+        if not documents:
+            return
+
+        vectors = self._normalize(np.stack([doc.vector for doc in documents]))
+        # Under the lock, two concurrent writes cannot both add the same chunk.
+        with self._lock:
+            keep = self._unique(vectors)
+            documents = [doc for doc, kept in zip(documents, keep) if kept]
+            vectors = vectors[keep]
+
+            rows = self._allocate(len(documents))
+            matrix, expires = self._segment
+            expires_at = int(time.time()) + self.ttl
+            chunks = []
+            for row, document, vector in zip(rows, documents, vectors):
+                # The row is marked free while it is rewritten so readers skip it.
+                expires[row] = 0
+                matrix[row] = vector
+                self._texts[row] = document.text
+                self._urls[row] = document.url
+                expires[row] = expires_at
+                chunks.append(
+                    {"row": int(row), "text": document.text, "url": document.url}
+                )
+            self._size = max(self._size, max(rows, default=-1) + 1)
+
+            if self.path is not None and chunks:
+                with open(self._file("chunks.jsonl"), "a") as log:
+                    log.write("".join(json.dumps(chunk) + "\n" for chunk in chunks))
+
+    def _allocate(self, count: int) -> list[int]:
+        """Reuses expired rows first and appends, growing the segment, for the rest."""
+
+        expires = self._segment[1][: self._size]
+        free = np.flatnonzero(expires <= time.time())[:count].tolist()
+        missing = count - len(free)
+        if self._size + missing > self.capacity:
+            self._grow(max(2 * self.capacity, self._size + missing))
+        return free + list(range(self._size, self._size + missing))
+
+    def flush(self):
+        """Writes the mapped segment to disk."""
+
+        if self.path is not None:
+            for array in self._segment:
+                array.flush()  # type: ignore
+
+    def __len__(self) -> int:
+        _, expires = self._snapshot()
+        return int(np.count_nonzero(expires > time.time()))
@@ -0,0 +1,134 @@
+# La clase ContextPacker arma el contexto del prompt a partir de los chunks recuperados: descarta los casi duplicados con una selección
+# MMR sobre los vectores que ya tenemos, recorta el solapamiento entre chunks de la misma página y llena un presupuesto de tokens.
+import numpy as np
+
+from models.chunk import Chunk
+from util import metrics
+
+try:
+    import tiktoken
+except ImportError:  # Sin tiktoken los tokens se estiman a razón de 4 caracteres por token.
+    tiktoken = None
+
+TOKEN_BUCKETS = (250, 500, 1000, 1500, 2000, 3000, 4000, 8000)
+
+
+class ContextPacker:
+    """Selects, trims and joins chunks into a context of at most max_tokens tokens.
+
+    Chunks are picked greedily by maximal marginal relevance: (1 - diversity) *
+    the similarity to the query minus diversity * the highest similarity to an
+    already picked chunk, so a higher diversity favours chunks unlike the picked
+    ones and 0 orders them by relevance alone. A chunk at least duplicate_treshold similar to a picked
+    one is dropped. Text that a picked chunk of the same url shares with the
+    start or end of the next one, the overlap of the splitter, is cut from the
+    latter. Chunks that do not fit the remaining budget are skipped.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 1000,
+        diversity: float = 0.3,
+        duplicate_treshold: float = 0.97,
+        max_overlap: int = 50,
+        min_overlap: int = 10,
+        encoding: str = "cl100k_base",
+        separator: str = "\n",
+    ) -> None:
+        self.max_tokens = max_tokens
+        self.diversity = diversity
+        self.duplicate_treshold = duplicate_treshold
+        self.max_overlap = max_overlap
+        self.min_overlap = min_overlap
+        self.separator = separator
+        self._encoding = tiktoken.get_encoding(encoding) if tiktoken else None
+
+    def count_tokens(self, text: str) -> int:
+        if self._encoding is None:
+            return -(-len(text) // 4)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def overlap(self, first: str, second: str) -> int:
+        """Length of the longest end of first that starts second, or 0 below min_overlap."""
+
+        for size in range(min(self.max_overlap, len(first), len(second)), 0, -1):
+            if size < self.min_overlap:
+                break
+            if first.endswith(second[:size]):
+                return size
+        return 0
+
+    def trim(self, text: str, neighbours: list[Chunk]) -> str:
+        """Cuts from text what it repeats of the picked chunks of its page."""
+
+        for neighbour in neighbours:
+            if size := self.overlap(neighbour.text, text):
+                text = text[size:].lstrip()
+            elif size := self.overlap(text, neighbour.text):
+                text = text[:-size].rstrip()
+        return text
+
+    def mmr_order(self, documents: list[Chunk]) -> tuple[list[int], int]:
+        """Indexes of documents in MMR order, without near duplicates, and how many were dropped."""
+
+        matrix = np.stack([doc.vector for doc in documents])
+        norms = np.linalg.norm(matrix, axis=1)
+        norms[norms == 0] = 1
+        matrix = matrix / norms[:, None]
+        pairwise = matrix @ matrix.T
+        relevance = np.array([doc.similarity for doc in documents], dtype=np.float32)
+
+        redundancy = np.zeros(len(documents), dtype=np.float32)
+        remaining = np.ones(len(documents), dtype=bool)
+        order, duplicates = [], 0
+        while remaining.any():
+            scores = (1 - self.diversity) * relevance - self.diversity * redundancy
+            scores[~remaining] = -np.inf
+            best = int(np.argmax(scores))
+            remaining[best] = False
+            if order and redundancy[best] >= self.duplicate_treshold:
+                duplicates += 1
+                continue
+            order.append(best)
+            redundancy = np.maximum(redundancy, pairwise[best])
+        return order, duplicates
+
+    def pack(self, documents: list[Chunk]) -> str:
+        """Builds the context from documents scored against the query."""
+
+        if not documents:
+            return ""
+        dropped = metrics.counter(
+            "context_chunks_dropped_total", "Chunks left out of the context by reason."
+        )
+
+        with metrics.span("context_packing", documents=len(documents)):
+            order, duplicates = self.mmr_order(documents)
+            separator_tokens = self.count_tokens(self.separator)
+            picked: list[Chunk] = []
+            texts: list[str] = []
+            used = over_budget = 0
+            for i in order:
+                document = documents[i]
+                text = self.trim(
+                    document.text, [doc for doc in picked if doc.url == document.url]
+                )
+                if not text:
+                    dropped.inc(reason="overlap")
+                    continue
+                tokens = self.count_tokens(text) + (separator_tokens if texts else 0)
+                if used + tokens > self.max_tokens:
+                    over_budget += 1
+                    continue
+                used += tokens
+                picked.append(document)
+                texts.append(text)
+
+        if duplicates:
+            dropped.inc(duplicates, reason="duplicate")
+        if over_budget:
+            dropped.inc(over_budget, reason="budget")
+        metrics.histogram(
+            "context_tokens", "Tokens of the packed context.", buckets=TOKEN_BUCKETS
+        ).observe(used)
+        return self.separator.join(texts)
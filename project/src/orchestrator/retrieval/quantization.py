@@ -0,0 +1,83 @@
+# La clase VectorCodec reduce lo que ocupa cada chunk en la caché: el índice KNN guarda una proyección PCA de pocas dimensiones y el
+# vector completo se guarda cuantizado a int8, que se usa para reordenar los candidatos con la consulta en precisión completa.
+import base64
+import io
+from typing import Optional
+
+import numpy as np
+
+
+class VectorCodec:
+    """PCA projection for the vector index plus int8 codes of the full vector.
+
+    The codes are symmetric per-vector scalar quantization: every vector keeps
+    its max-abs scale as a float32 next to one signed byte per dimension.
+    """
+
+    def __init__(self, components: np.ndarray, mean: np.ndarray) -> None:
+        self.components = np.asarray(components, dtype=np.float32)
+        self.mean = np.asarray(mean, dtype=np.float32)
+
+    @property
+    def dimension(self) -> int:
+        """Dimension of the vectors stored in the index."""
+
+        return self.components.shape[0]
+
+    @classmethod
+    def fit(cls, vectors: np.ndarray, n_components: int) -> "VectorCodec":
+        """Fits the projection on a sample of the cached vectors."""
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) < n_components:
+            raise ValueError(
+                f"At least {n_components} vectors are needed, got {len(vectors)}"
+            )
+        mean = vectors.mean(axis=0)
+        _, _, vt = np.linalg.svd(vectors - mean, full_matrices=False)
+        return cls(vt[:n_components], mean)
+
+    def project(self, vectors: np.ndarray) -> np.ndarray:
+        """Projects the vectors to the index space, normalized for cosine distance."""
+
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        projected = (vectors - self.mean) @ self.components.T
+        norms = np.linalg.norm(projected, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return projected / norms
+
+    @staticmethod
+    def quantize(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    @staticmethod
+    def dequantize(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * scales[:, None]
+
+    def encode(self, vector: np.ndarray) -> str:
+        """Packs the int8 codes of a vector and its scale as base64."""
+
+        codes, scales = self.quantize(vector)
+        return base64.b64encode(scales.tobytes() + codes.tobytes()).decode("ascii")
+
+    def decode(self, payload: str) -> np.ndarray:
+        raw = base64.b64decode(payload)
+        scale = np.frombuffer(raw[:4], dtype=np.float32)
+        codes = np.frombuffer(raw[4:], dtype=np.int8)[None, :]
+        return self.dequantize(codes, scale)[0]
+
+    def dumps(self) -> bytes:
+        buffer = io.BytesIO()
+        np.savez(buffer, components=self.components, mean=self.mean)
+        return buffer.getvalue()
+
+    @classmethod
+    def loads(cls, data: Optional[bytes]) -> Optional["VectorCodec"]:
+        if not data:
+            return None
+        arrays = np.load(io.BytesIO(data))
+        return cls(arrays["components"], arrays["mean"])
@@ -0,0 +1,174 @@
+# La clase RetentionPolicy decide cuánto vive cada chunk en Redis: el TTL depende del dominio de la página, se renueva cuando el chunk
+# se sirve desde la caché (acumulando los hits y enviándolos en lotes) y un tope de chunks desaloja primero a los menos útiles.
+import os
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlparse
+
+import redis
+
+from util import metrics
+
+USAGE_KEY = "retention:chunks"
+
+
+class RetentionPolicy:
+    """TTLs by domain, sliding refresh on hits and a cap on the cached chunks.
+
+    With max_chunks, every chunk has a usage score in a sorted set: the time it
+    was written plus hit_weight seconds per hit. When the cache holds more than
+    max_chunks, the lowest scores, the oldest and least served chunks, are
+    deleted first. Without it no chunk is tracked.
+    """
+
+    def __init__(
+        self,
+        ttl: int = 3600,
+        domain_ttls: Optional[dict[str, int]] = None,
+        max_chunks: Optional[int] = None,
+        hit_weight: float = 600,
+        flush_size: int = 256,
+        flush_interval: float = 5.0,
+    ) -> None:
+        self.ttl = ttl
+        self.domain_ttls = domain_ttls or {}
+        self.max_chunks = max_chunks
+        self.hit_weight = hit_weight
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._hits: dict[str, tuple[str, int]] = {}
+        self._last_flush = time.monotonic()
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_env(cls) -> "RetentionPolicy":
+        """Builds the policy from CACHE_TTL, CACHE_DOMAIN_TTLS and CACHE_MAX_CHUNKS."""
+
+        return cls(
+            ttl=int(os.environ.get("CACHE_TTL", 3600)),
+            domain_ttls=cls.parse_domain_ttls(os.environ.get("CACHE_DOMAIN_TTLS", "")),
+            max_chunks=int(os.environ["CACHE_MAX_CHUNKS"])
+            if "CACHE_MAX_CHUNKS" in os.environ
+            else None,
+        )
+
+    @staticmethod
+    def parse_domain_ttls(value: str) -> dict[str, int]:
+        """Parses "example.com=86400,news.example.org=600"."""
+
+        ttls = {}
+        for item in filter(None, (part.strip() for part in value.split(","))):
+            domain, ttl = item.split("=")
+            ttls[domain.strip().lower()] = int(ttl)
+        return ttls
+
+    def ttl_for(self, url: str) -> int:
+        """TTL of the most specific configured domain of the url, or the default."""
+
+        host = (urlparse(url).hostname or "").lower()
+        while host:
+            if host in self.domain_ttls:
+                return self.domain_ttls[host]
+            _, _, host = host.partition(".")
+        return self.ttl
+
+    def on_write(self, pipeline, key: str, url: str):
+        pipeline.expire(key, self.ttl_for(url))
+        if self.max_chunks is not None:
+            pipeline.zadd(USAGE_KEY, {key: time.time()})
+
+    def forget(self, client: redis.Redis, key: str):
+        """Stops tracking a chunk that Redis expired or evicted."""
+
+        if self.max_chunks is not None:
+            client.zrem(USAGE_KEY, key)
+
+    def record_hits(self, client: redis.Redis, hits: list[tuple[str, str]]):
+        """Buffers the (key, url) of served chunks, flushing once enough are pending."""
+
+        metrics.counter("chunk_hits_total", "Chunks served from the cache.").inc(
+            len(hits)
+        )
+        with self._lock:
+            for key, url in hits:
+                _, count = self._hits.get(key, (url, 0))
+                self._hits[key] = (url, count + 1)
+            due = (
+                len(self._hits) >= self.flush_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+        if due:
+            self.flush(client)
+
+    def flush(self, client: redis.Redis):
+        """Extends the TTL and raises the usage score of the buffered hits in one round trip."""
+
+        with self._lock:
+            hits, self._hits = self._hits, {}
+            self._last_flush = time.monotonic()
+        if not hits:
+            return
+
+        pipeline = client.pipeline(transaction=False)
+        for key, (url, count) in hits.items():
+            # GT only extends, a refresh never shortens a longer TTL.
+            pipeline.expire(key, self.ttl_for(url), gt=True)
+            if self.max_chunks is not None:
+                pipeline.zadd(
+                    USAGE_KEY, {key: count * self.hit_weight}, xx=True, incr=True
+                )
+        pipeline.execute()
+        metrics.counter(
+            "cache_ttl_refreshes_total", "Chunk TTLs extended by hits."
+        ).inc(len(hits))
+
+    def start_flusher(self, client: redis.Redis) -> threading.Thread:
+        """Flushes the buffered hits every flush_interval seconds from a daemon thread.
+
+        Without it hits are only sent by the next record_hits, so the last ones
+        before a quiet period would wait for more traffic.
+        """
+
+        def run():
+            while not self._stopped.wait(self.flush_interval):
+                try:
+                    self.flush(client)
+                except redis.exceptions.RedisError:
+                    metrics.counter(
+                        "cache_ttl_refresh_failures_total",
+                        "Batches of hits that could not be sent to Redis.",
+                    ).inc()
+
+        thread = threading.Thread(target=run, name="retention-flusher", daemon=True)
+        thread.start()
+        return thread
+
+    def close(self, client: redis.Redis):
+        """Stops the flusher thread and sends the hits still buffered."""
+
+        self._stopped.set()
+        self.flush(client)
+
+    def enforce_cap(self, client: redis.Redis):
+        """Deletes the least useful chunks until at most max_chunks are tracked."""
+
+        if self.max_chunks is None:
+            return
+
+        evictions = metrics.counter(
+            "cache_evictions_total", "Chunks removed from Redis by reason."
+        )
+        tracked = client.zcard(USAGE_KEY)
+        excess = tracked - self.max_chunks  # type: ignore
+        if excess > 0:
+            popped = client.zpopmin(USAGE_KEY, excess)
+            keys = [key for key, _ in popped]  # type: ignore
+            # Keys that already expired are popped too, only live ones count as evicted.
+            deleted = client.delete(*keys) if keys else 0
+            evictions.inc(deleted, reason="cap")  # type: ignore
+            tracked -= len(keys)
+        metrics.gauge(
+            "cache_tracked_chunks", "Chunks tracked by the retention policy."
+        ).set(tracked)
@@ -1,21 +1,28 @@
 # La clase Retriever está diseñada para generar contexto basado en una consulta, recuperando y procesando documentos relevantes desde la 
 # caché o desde internet mediante el uso de embeddings, búsqueda, raspado y cálculos de similitud coseno.
 import asyncio
+from contextlib import nullcontext
 import json
+import logging
 import time
-from typing import Any, AsyncGenerator
+from typing import Any, AsyncGenerator, Optional
 import numpy as np
-import pandas as pd
-from util import logger
-from models.document import Document
+from util import logger, metrics
+from util.admission import AdmissionController
+from models.chunk import Chunk
 from retrieval.search import Searcher
 from retrieval.cache import VectorDbCache
 from retrieval.splitter import Splitter
 from retrieval.scraper import Scraper
 from retrieval.embeddings import Embeddings
-from sklearn.metrics.pairwise import cosine_similarity
+from retrieval.packer import ContextPacker
 from models.search import SearchDoc, SearchResult
 
+# Rellenos de la caché en segundo plano; la referencia evita que el recolector de basura los cancele.
+background_fills: set[asyncio.Task] = set()
+# URLs que algún relleno está raspando, para no raspar la misma página dos veces a la vez.
+filling_urls: set[str] = set()
+
 
 class Retriever:
     def __init__(
@@ -25,138 +32,450 @@ class Retriever:
         scraper: Scraper,
         embeddings: Embeddings,
         splitter: Splitter,
+        packer: Optional[ContextPacker] = None,
+        admission: Optional[AdmissionController] = None,
+        max_background_fills: int = 16,
     ) -> None:
         self.cache = cache
         self.searcher = searcher
         self.scraper = scraper
         self.embeddings = embeddings
         self.splitter = splitter
+        self.packer = packer
+        self.admission = admission
+        self.max_background_fills = max_background_fills
 
     async def get_context(
-        self, query: str, cache_treshold: float = 0.85, k: int = 10
+        self,
+        query: str,
+        cache_treshold: float = 0.85,
+        k: int = 10,
+        doc_treshold: float | None = None,
+        query_vector: list[float] | None = None,
+        snippet_first: bool = False,
+        cache_only: bool = False,
     ) -> AsyncGenerator[dict, None]:
-        """Generates context based on query. It can retrieve from cache or from internet."""
+        """Generates context based on query. It can retrieve from cache or from internet.
+
+        When doc_treshold is given, a cache miss does not discard the cached
+        documents: the ones above doc_treshold are kept and only the shortfall
+        is fetched from the web, skipping the URLs that are already cached.
+        The query_vector can be passed when the caller already embedded the query.
+        With a packer the context is fitted to its token budget, otherwise the
+        texts of the documents are joined as they are.
+        With snippet_first, a miss that needs pages from the web yields a
+        snippet_context event, built from the cached documents kept and the
+        snippets of the search results, instead of the context event. The pages
+        are then scraped and written to the cache in the background.
+        With cache_only, a miss neither searches nor scrapes: the context is
+        built from the cached documents above doc_treshold, or cache_treshold.
+        When none is left, a no_cached_answer event with the seconds to wait
+        before retrying is yielded instead of the context.
+        Progress events are yielded for every stage along with its timing.
+        """
+
+        timings: dict[str, float] = {}
+
+        if query_vector is None:
+            with metrics.span("query_embedding") as span:
+                async with self.stage("embedding"):
+                    query_vector = (await self.embeddings.run([query]))[0]
+            timings["query_embedding"] = span.duration
+            yield self.progress_event("query_embedded", seconds=span.duration)
 
-        query_vector = await self.embeddings.run([query])
-        documents = await self.cache.find_similar(query_vector[0], k)
-        quality_cache = await self.evaluate_retrieval(documents, cache_treshold)
+        with metrics.span("cache_lookup", k=k) as span:
+            documents = await self.cache.find_similar(query_vector, k)
+            quality_cache = await self.evaluate_retrieval(documents, cache_treshold)
+        timings["cache_lookup"] = span.duration
 
-        logger.info(f"QUALITY CACHE: {quality_cache}")
+        cached = []
+        if not quality_cache and doc_treshold is not None:
+            cached = self.select_cached(documents, doc_treshold)
+        logger.debug(
+            "Cache lookup",
+            extra={
+                "stage": "cache_lookup",
+                "duration": span.duration,
+                "hit": quality_cache,
+                "kept": len(cached),
+            },
+        )
+        self.record_cache_lookup(quality_cache, cached)
+        await self.cache.touch(documents if quality_cache else cached)
 
-        if quality_cache:
+        if cache_only and not quality_cache:
+            documents = (
+                cached
+                if doc_treshold is not None
+                else self.select_cached(documents, cache_treshold)
+            )
+            if not documents:
+                # Without context the LLM would answer from nothing, the client retries later.
+                metrics.counter(
+                    "cache_only_unanswered_total",
+                    "Degraded requests without cached documents to answer from.",
+                ).inc()
+                retry_after = (
+                    self.admission.retry_after() if self.admission is not None else 1
+                )
+                yield self.progress_event("no_cached_answer", retry_after=retry_after)
+                return
+        from_cache = quality_cache or cache_only
+
+        if from_cache:
             search_results = SearchResult(
                 items=[SearchDoc(link=doc.url) for doc in documents]
             )
         else:
-            search_results = await self.searcher.run(query)
+            with metrics.span("search") as span:
+                search_results = await self.searcher.run(query)
+            timings["search"] = span.duration
 
         yield {"event": "search", "data": json.dumps(search_results.model_dump())}
 
-        if not quality_cache:
-            documents = await self.search_for_documents(search_results, query_vector, k)
-            await self.cache.write(documents)
+        if not from_cache:
+            if len(cached) >= k:
+                documents = cached[:k]
+            else:
+                pending = self.exclude_cached_urls(search_results, cached)
+                if snippet_first and any(item.snippet for item in pending.items):
+                    self.fill_in_background(query_vector, pending, k - len(cached))
+                    yield self.progress_event(
+                        "context_ready",
+                        documents=len(cached),
+                        snippets=len(pending.items),
+                        stages=timings,
+                    )
+                    yield {
+                        "event": "snippet_context",
+                        "data": self.snippet_context(cached, pending),
+                    }
+                    return
+
+                fetched = []
+                if pending.items:
+                    start = time.perf_counter()
+                    pages = []
+                    try:
+                        async for page in self.scrape_pages(pending):
+                            pages.append(page)
+                            yield self.progress_event(
+                                "page_scraped",
+                                url=page["url"],
+                                ok=bool(page["text"]),
+                                seconds=time.perf_counter() - start,
+                            )
+                        timings["scrape"] = metrics.record(
+                            "scrape", start, pages=len(pending.items)
+                        )
+                        logger.info(
+                            "Pages scraped",
+                            extra={
+                                "stage": "scrape",
+                                "duration": timings["scrape"],
+                                "pages": len(pages),
+                            },
+                        )
+
+                        with metrics.span("embedding") as span:
+                            chunks = await self.embed_pages(pages)
+                        timings["embedding"] = span.duration
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # The client went away, the pages already scraped are still cached
+                        # for the next query; the rest are not fetched.
+                        if any(page["text"] for page in pages):
+                            self.fill_in_background(
+                                query_vector, pending, k - len(cached), pages=pages
+                            )
+                        raise
+
+                    # Ranked with k, not the shortfall: merge_documents picks the best
+                    # k of cached and fetched together.
+                    fetched = await self.rank_documents(query_vector, chunks, k)
+                    with metrics.span("cache_write", documents=len(fetched)) as span:
+                        # Shielded so that a disconnect does not leave the write half done.
+                        await asyncio.shield(self.cache.write(fetched))
+                    timings["cache_write"] = span.duration
+                    yield self.progress_event(
+                        "chunks_embedded",
+                        count=len(chunks),
+                        seconds=timings["embedding"],
+                    )
+                documents = self.merge_documents(cached, fetched, k)
+
+        yield self.progress_event(
+            "context_ready", documents=len(documents), stages=timings
+        )
+
+        yield {"event": "context", "data": self.pack(documents)}
+
+    def snippet_context(self, cached: list[Chunk], search_results: SearchResult) -> str:
+        """Joins the cached documents and the title and snippet of every search result."""
+
+        context = self.pack(cached)
+        snippets = [
+            "\n".join(filter(None, [item.title, item.snippet]))
+            for item in search_results.items
+            if item.snippet
+        ]
+        return "\n".join(filter(None, [context, *snippets]))
+
+    def pack(self, documents: list[Chunk]) -> str:
+        if self.packer is None:
+            return "\n".join([doc.text for doc in documents])
+        return self.packer.pack(documents)
+
+    def fill_in_background(
+        self,
+        query_vector,
+        search_results: SearchResult,
+        k: int,
+        pages: Optional[list[dict[str, Any]]] = None,
+    ):
+        """Caches the k best chunks of the search results without blocking the request.
+
+        When the pages are given they are only embedded, nothing else is scraped.
+        URLs that another fill is already caching are left to it, and with
+        max_background_fills fills running, across requests, the fill is skipped.
+        """
+
+        skipped = metrics.counter(
+            "background_fills_skipped_total", "Cache fills not started by reason."
+        )
+        urls = {item.link for item in search_results.items} - filling_urls
+        if pages is not None:
+            pages = [page for page in pages if page["url"] in urls]
+            urls = {page["url"] for page in pages}
+        if not urls:
+            skipped.inc(reason="duplicate")
+            return
+        if len(background_fills) >= self.max_background_fills:
+            skipped.inc(reason="limit")
+            return
+        search_results = SearchResult(
+            items=[item for item in search_results.items if item.link in urls]
+        )
+
+        async def fill():
+            with metrics.span("background_fill", pages=len(search_results.items)):
+                if pages is None:
+                    documents = await self.search_for_documents(
+                        search_results, query_vector, k
+                    )
+                else:
+                    chunks = await self.embed_pages(pages)
+                    documents = await self.rank_documents(query_vector, chunks, k)
+                await self.cache.write(documents)
+            logger.info(
+                "Background fill done",
+                extra={"stage": "background_fill", "documents": len(documents)},
+            )
+
+        inflight = metrics.gauge(
+            "background_fills_inflight", "Cache fills running in the background."
+        )
+
+        def done(task: asyncio.Task):
+            background_fills.discard(task)
+            filling_urls.difference_update(urls)
+            inflight.set(len(background_fills))
+            if not task.cancelled() and task.exception() is not None:
+                logger.warning(
+                    "Background fill failed",
+                    exc_info=task.exception(),
+                    extra={"stage": "background_fill"},
+                )
+
+        task = asyncio.create_task(fill())
+        background_fills.add(task)
+        filling_urls.update(urls)
+        inflight.set(len(background_fills))
+        task.add_done_callback(done)
+
+    def stage(self, name: str):
+        """Slot of the stage in the admission controller, if there is one."""
+
+        if self.admission is None:
+            return nullcontext()
+        return self.admission.stage(name)
+
+    def progress_event(self, event: str, **data) -> dict:
+        """Builds a progress event for the client with its data as JSON."""
+
+        return {"event": event, "data": json.dumps(data)}
+
+    def record_cache_lookup(self, quality_cache: bool, cached: list[Chunk]):
+        """Counts the lookup as a cache hit, a partial hit or a miss."""
+
+        result = "hit" if quality_cache else "partial" if cached else "miss"
+        lookups = metrics.counter("cache_lookups_total", "Chunk cache lookups.")
+        lookups.inc(result=result)
+        total = sum(lookups.value(result=r) for r in ("hit", "partial", "miss"))
+        metrics.gauge("cache_hit_ratio", "Share of lookups served by the cache.").set(
+            lookups.value(result="hit") / total
+        )
+
+    def select_cached(
+        self, documents: list[Chunk], doc_treshold: float
+    ) -> list[Chunk]:
+        """Keeps the cached documents that are individually good enough."""
+
+        return [doc for doc in documents if doc.similarity > doc_treshold]
+
+    def exclude_cached_urls(
+        self, search_results: SearchResult, cached: list[Chunk]
+    ) -> SearchResult:
+        """Removes from the search results the pages that are already cached."""
 
-        context = "\n".join([doc.text for doc in documents])
-        yield {"event": "context", "data": context}
+        cached_urls = {doc.url for doc in cached}
+        return SearchResult(
+            items=[item for item in search_results.items if item.link not in cached_urls]
+        )
+
+    def merge_documents(
+        self, cached: list[Chunk], fetched: list[Chunk], k: int
+    ) -> list[Chunk]:
+        """Merges cached and fetched documents into a single top k."""
+
+        merged = sorted(cached + fetched, key=lambda doc: doc.similarity, reverse=True)
+        return merged[:k]
 
     async def search_for_documents(
         self, search_results, query_vector, k
-    ) -> list[Document]:
+    ) -> list[Chunk]:
         """Searches for relevant information on the internet."""
 
-        start = time.perf_counter()
+        with metrics.span("scrape", pages=len(search_results.items)) as span:
+            pages = [page async for page in self.scrape_pages(search_results)]
+        logger.info(
+            "Pages scraped",
+            extra={"stage": "scrape", "duration": span.duration, "pages": len(pages)},
+        )
+
+        documents = await self.embed_pages(pages)
+        return await self.rank_documents(query_vector, documents, k)
 
-        results = search_results.model_dump()
-        tasks = [self.scraper.fetch(item["link"]) for item in results["items"]]
-        pages = await asyncio.gather(*tasks)
+    async def scrape_pages(
+        self, search_results: SearchResult
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """Scrapes the search results, yielding every page as soon as it is ready."""
 
-        end = time.perf_counter()
-        logger.info(f"SCRAPE TIME: {end - start}")
+        urls = [item.link for item in search_results.items]
+        async with self.stage("scrape"):
+            async for page in self.scraper.fetch_many(urls):
+                yield page
+
+    async def embed_pages(self, pages: list[dict[str, Any]]) -> list[Chunk]:
+        """Splits the scraped pages into chunks and embeds them.
+
+        The vectors of the chunks are rows of one float32 matrix.
+        """
 
-        documents = []
+        texts, urls = [], []
         page_count = 0
-        for page in pages:
-            if page["text"]:
-                page_count += 1
-                splits = await self.splitter.split(page["text"])
-                for split in splits:
-                    documents.append({"text": split, "url": page["url"]})
+        with metrics.span("split"):
+            for page in pages:
+                if page["text"]:
+                    page_count += 1
+                    splits = await self.splitter.split(page["text"])
+                    texts.extend(splits)
+                    urls.extend([page["url"]] * len(splits))
 
-        logger.info(f"SCRAPED PAGES: {page_count}")
-        logger.info(f"SPLIT COUNT: {len(documents)}")
+        logger.debug(
+            "Pages split",
+            extra={"stage": "split", "pages": page_count, "chunks": len(texts)},
+        )
 
-        embedding_start_time = time.perf_counter()
-        texts = [doc["text"] for doc in documents]
-        embeddings = await self.embeddings.run(texts)
+        if not texts:
+            return []
 
-        for i, vector in enumerate(embeddings):
-            documents[i]["vector"] = vector
+        with metrics.span("chunk_embedding", chunks=len(texts)) as span:
+            async with self.stage("embedding"):
+                embeddings = await self.embeddings.run(texts)
+        matrix = np.asarray(embeddings, dtype=np.float32)
 
-        embedding_time = time.perf_counter() - embedding_start_time
-        logger.info(f"EMBEDDING TIME: {embedding_time}")
+        logger.debug(
+            "Chunks embedded",
+            extra={
+                "stage": "chunk_embedding",
+                "duration": span.duration,
+                "chunks": len(texts),
+            },
+        )
+        return [
+            Chunk(text, url, vector) for text, url, vector in zip(texts, urls, matrix)
+        ]
 
-        relevant_documents = await self.get_most_similar(query_vector, documents, k)
-        mean_score = await self.get_mean_similarity(relevant_documents)
+    async def rank_documents(
+        self, query_vector, documents: list[Chunk], k
+    ) -> list[Chunk]:
+        """Keeps the k chunks closest to the query."""
+
+        if not documents:
+            return []
 
-        logger.info(f"RETRIEVAL SCORE: {mean_score}")
+        relevant_documents = await self.get_most_similar(query_vector, documents, k)
+        if logger.isEnabledFor(logging.DEBUG):
+            mean_score = await self.get_mean_similarity(relevant_documents)
+            logger.debug(
+                "Documents ranked", extra={"stage": "rank", "score": mean_score}
+            )
         return relevant_documents
 
-    async def get_most_similar(self, query_vector, data, k=5) -> list[Document]:
+    async def get_most_similar(
+        self, query_vector, data: list[Chunk], k=5
+    ) -> list[Chunk]:
         """
         Esta función recupera los textos más relevantes basándose en la similitud coseno con un vector de consulta dado.
         query_vector: El parámetro query_vector es un vector que representa la consulta para la cual deseas encontrar los textos más similares 
         basados en la similitud coseno. Se espera que sea una lista de valores numéricos que representan las características del vector de consulta.
-        data: El parámetro data en el método get_most_similar se espera que sea una lista de diccionarios donde cada diccionario representa un 
-        documento con claves como "text", "url" y "vector". La clave "vector" debe contener una lista que representa la representación vectorial del 
-        texto del documento.
+        data: El parámetro data en el método get_most_similar es una lista de objetos Chunk, cada uno con su texto, su url y su vector float32.
         k: El parámetro k en la función get_most_similar representa el número de textos más relevantes que deseas recuperar basándote en la similitud 
         coseno. Especifica los k documentos más similares al vector de consulta. En el fragmento de código proporcionado, k=5 es el valor 
         predeterminado (opcional).
-        return: La función get_most_similar devuelve una lista de objetos Document que representan los textos más relevantes basados en la similitud 
+        return: La función get_most_similar devuelve una lista de objetos Chunk que representan los textos más relevantes basados en la similitud 
         coseno con el vector de consulta proporcionado.
         """
         """Get most relevant texts based on cosine similarity"""
 
-        query_vector = np.array(query_vector).reshape(1, -1)
-
-        def compute_cosine_similarity(row):
-            return cosine_similarity(query_vector, row)[0][0]
+        query = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+        matrix = np.stack([chunk.vector for chunk in data])
+        norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1)
+        norms[norms == 0] = 1
+        scores = matrix @ query / norms
 
-        df: Any = pd.DataFrame(data)
-        df["vector"] = df["vector"].apply(lambda x: np.array(x).reshape(1, -1))
-        df["similarity"] = df["vector"].apply(compute_cosine_similarity)
-        similar = df.nlargest(k, "similarity")[["text", "url", "vector", "similarity"]]
-        similar["vector"] = similar["vector"].apply(lambda x: x[0].tolist())
+        k = min(k, len(data))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
 
-        json_docs = similar.to_dict("records")
+        return [data[i].with_similarity(float(scores[i])) for i in top]
 
-        return [Document(**json_doc) for json_doc in json_docs]
     async def evaluate_retrieval(
        
-        self, documents: list[Document], treshold: float
+        self, documents: list[Chunk], treshold: float
     ) -> bool:
 
         """Checks if the similarity average is high enough to use document set.
         """
 
       # Este bloque de código es un método llamado evaluate_retrieval dentro de la clase Retriever. 
-      # Toma una lista de objetos Document como entrada y un valor de umbral. Esto es lo que hace:
+      # Toma una lista de objetos Chunk como entrada y un valor de umbral. Esto es lo que hace:
         if documents:
             cache_score = sum(
                 doc.similarity for doc in documents if doc.similarity is not None
             ) / len(documents)
 
-            logger.info(f"CACHE SCORE: {cache_score}")
+            logger.debug("Cache score", extra={"score": cache_score})
             return cache_score > treshold
         return False
 
-    async def get_mean_similarity(self, documents: list[Document]) -> float:
+    async def get_mean_similarity(self, documents: list[Chunk]) -> float:
         """
     Esta función en Python calcula el puntaje medio de similitud a partir de una lista de documentos.
-    documents: El parámetro documents es una lista de objetos Document. La función calcula el puntaje medio de similitud de estos documentos 
+    documents: El parámetro documents es una lista de objetos Chunk. La función calcula el puntaje medio de similitud de estos documentos 
     sumando los puntajes de similitud de cada documento (si el puntaje de similitud no es None) y luego dividiendo por el número total de 
     documentos en la lista. Si la lista está vacía, devuelve 0.
-    type documents: list[Document]
+    type documents: list[Chunk]
     return: La función get_mean_similarity devuelve el puntaje medio de similitud calculado a partir de la lista de documentos proporcionada como
     entrada. Si la lista no está vacía, calcula el puntaje medio de similitud sumando los puntajes de similitud de todos los documentos que no 
     son None y dividiendo por el número total de documentos. Si la lista está vacía, devuelve 0.
@@ -0,0 +1,322 @@
+# La clase ScrapeScheduler reparte el raspado entre todas las requests del proceso: limita las conexiones totales y por host, espacia
+# las peticiones a un mismo host, corta los dominios que fallan seguido y aísla el error de cada URL para que no tumbe al resto.
+import asyncio
+from collections import defaultdict
+import time
+from typing import Any, AsyncGenerator, Optional
+from urllib.parse import urlparse
+
+from retrieval.scraper import Scraper, TierThrottled
+from util import metrics
+from util.logger import sampled_logger
+
+# Respuestas con las que un host indica que nos está bloqueando o no da abasto.
+BLOCKING_STATUS = {403, 429, 503}
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures and lets one probe through after reset_after seconds."""
+
+    def __init__(self, failure_threshold: int = 5, reset_after: float = 60) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < self.reset_after:
+            return False
+        self.probing = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def cancel(self):
+        # A cancelled probe neither closes nor reopens the breaker.
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class HostState:
+    __slots__ = ("semaphore", "breaker", "latency", "next_start", "active", "last_used")
+
+    def __init__(self, per_host: int, breaker: CircuitBreaker) -> None:
+        self.semaphore = asyncio.Semaphore(per_host)
+        self.breaker = breaker
+        self.latency: Optional[float] = None
+        self.next_start = 0.0
+        # Fetches waiting for or holding a slot of the host.
+        self.active = 0
+        self.last_used = time.monotonic()
+
+
+class ScrapeScheduler(Scraper):
+    """Process-wide scheduler in front of a Scraper.
+
+    Every fetch holds a global and a per-host slot, waits at least min_interval
+    since the previous request to the host started and gets a timeout of
+    timeout_factor times the moving average latency of the host, within
+    [min_timeout, max_timeout]. A failed, timed out or blocked fetch yields a page
+    without text. fetch_many stops waiting after deadline seconds.
+    When the scraper raises TierThrottled the fetch gives back its slots, waits
+    the Retry-After and tries again, up to tier_retries times; the busy tier says
+    nothing about the host, so it neither trips its breaker nor eats its timeout.
+    Hosts unused for idle_after seconds whose breaker is closed are forgotten.
+    """
+
+    def __init__(
+        self,
+        scraper: Scraper,
+        max_concurrency: int = 64,
+        per_host: int = 4,
+        min_interval: float = 0.1,
+        failure_threshold: int = 5,
+        reset_after: float = 60,
+        min_timeout: float = 2,
+        max_timeout: float = 10,
+        timeout_factor: float = 3,
+        deadline: Optional[float] = 8,
+        tier_retries: int = 2,
+        idle_after: float = 300,
+    ) -> None:
+        self.scraper = scraper
+        self.max_concurrency = max_concurrency
+        self.per_host = per_host
+        self.min_interval = min_interval
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_factor = timeout_factor
+        self.deadline = deadline
+        self.tier_retries = tier_retries
+        self.idle_after = idle_after
+        self._last_prune = time.monotonic()
+        # Semaphores are created lazily, inside the event loop that uses them.
+        self._global: Optional[asyncio.Semaphore] = None
+        self._hosts: dict[str, HostState] = defaultdict(
+            lambda: HostState(
+                self.per_host, CircuitBreaker(self.failure_threshold, self.reset_after)
+            )
+        )
+
+    def host(self, url: str) -> HostState:
+        """State of the host of the url, marked as used now."""
+
+        now = time.monotonic()
+        if now - self._last_prune >= self.idle_after:
+            self.prune(now)
+        host = self._hosts[urlparse(url).netloc]
+        host.last_used = now
+        return host
+
+    def prune(self, now: float):
+        """Forgets the hosts idle for idle_after seconds whose breaker is closed."""
+
+        self._last_prune = now
+        idle = [
+            domain
+            for domain, host in self._hosts.items()
+            if not host.active
+            and host.breaker.opened_at is None
+            and now - host.last_used >= self.idle_after
+        ]
+        for domain in idle:
+            del self._hosts[domain]
+        metrics.gauge("scrape_hosts_tracked", "Hosts tracked by the scheduler.").set(
+            len(self._hosts)
+        )
+
+    def timeout_for(self, host: HostState) -> float:
+        if host.latency is None:
+            return self.max_timeout
+        return min(
+            self.max_timeout, max(self.min_timeout, self.timeout_factor * host.latency)
+        )
+
+    async def fetch(self, url: str) -> dict[str, Any]:
+        for attempt in range(self.tier_retries + 1):
+            try:
+                return await self.fetch_once(url)
+            except TierThrottled as e:
+                if attempt == self.tier_retries:
+                    break
+                await asyncio.sleep(e.retry_after)
+
+        metrics.counter(
+            "scrape_skipped_total", "Pages not scraped by the scheduler by reason."
+        ).inc(reason="throttled")
+        return {"url": url, "text": None}
+
+    async def fetch_once(self, url: str) -> dict[str, Any]:
+        """Fetches the url holding its slots, TierThrottled is raised to the caller."""
+
+        host = self.host(url)
+        if self._global is None:
+            self._global = asyncio.Semaphore(self.max_concurrency)
+
+        host.active += 1
+        try:
+            return await self._fetch_holding(url, host)
+        finally:
+            host.active -= 1
+
+    async def _fetch_holding(self, url: str, host: HostState) -> dict[str, Any]:
+        skipped = metrics.counter(
+            "scrape_skipped_total", "Pages not scraped by the scheduler by reason."
+        )
+        async with self._global, host.semaphore:  # type: ignore
+            # Checked once a slot is free, so queued fetches see the latest failures.
+            if not host.breaker.allow():
+                skipped.inc(reason="circuit_open")
+                return {"url": url, "text": None}
+
+            # Politeness: requests to the same host start min_interval apart.
+            now = time.monotonic()
+            start_at = max(now, host.next_start)
+            host.next_start = start_at + self.min_interval
+            if start_at > now:
+                await asyncio.sleep(start_at - now)
+
+            start = time.monotonic()
+            try:
+                page = await asyncio.wait_for(
+                    self.scraper.timed_fetch(url), self.timeout_for(host)
+                )
+            except (asyncio.CancelledError, TierThrottled):
+                host.breaker.cancel()
+                raise
+            except asyncio.TimeoutError:
+                skipped.inc(reason="timeout")
+                host.breaker.failure()
+                return {"url": url, "text": None}
+            except Exception as e:
+                sampled_logger.info(
+                    "Scrape failed", extra={"stage": "scrape", "url": url, "error": e}
+                )
+                skipped.inc(reason="error")
+                host.breaker.failure()
+                return {"url": url, "text": None}
+
+        elapsed = time.monotonic() - start
+        host.latency = (
+            elapsed if host.latency is None else 0.8 * host.latency + 0.2 * elapsed
+        )
+        if page.get("status") in BLOCKING_STATUS:
+            skipped.inc(reason="blocked")
+        self.record(host, page)
+        return page
+
+    def record(self, host: HostState, page: dict[str, Any]):
+        """Updates the breaker of the host with the outcome of its page.
+
+        A page without status was lost by the scraper tier, not by the host, so it
+        neither opens nor closes the breaker. Errors, timeouts, blocking answers
+        and server errors of the host count as failures.
+        """
+
+        status = page.get("status")
+        if status is None:
+            host.breaker.cancel()
+        elif (
+            "error" in page
+            or status in BLOCKING_STATUS
+            or status == 408
+            or status >= 500
+        ):
+            host.breaker.failure()
+        else:
+            host.breaker.success()
+
+    async def fetch_many(self, urls: list[str]) -> AsyncGenerator[dict[str, Any], None]:
+        """Yields every page as it is ready, and the pages missing at the deadline without text."""
+
+        if self.scraper.batched:
+            async for page in self.fetch_batched(urls):
+                yield page
+            return
+
+        tasks = {asyncio.create_task(self.fetch(url)): url for url in urls}
+        loop = asyncio.get_running_loop()
+        stop_at = None if self.deadline is None else loop.time() + self.deadline
+        pending = set(tasks)
+        try:
+            while pending:
+                timeout = None if stop_at is None else max(0, stop_at - loop.time())
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    break
+                for task in done:
+                    yield task.result()
+
+            if pending:
+                metrics.counter(
+                    "scrape_skipped_total",
+                    "Pages not scraped by the scheduler by reason.",
+                ).inc(len(pending), reason="deadline")
+            for task in pending:
+                yield {"url": tasks[task], "text": None}
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def fetch_batched(
+        self, urls: list[str]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """Hands the urls of closed circuits to a batched scraper in one call.
+
+        Only the breakers and the deadline apply here. The per-host slots and the
+        politeness delay are left out on purpose: the tier renders at most
+        SCRAPER_BATCH_CONCURRENCY pages of a batch at a time and each replica at
+        most SCRAPER_MAX_INFLIGHT, and the urls of one query are the search results
+        of different sites, so holding host slots here would only serialize the
+        batch behind unrelated requests.
+        """
+
+        skipped = metrics.counter(
+            "scrape_skipped_total", "Pages not scraped by the scheduler by reason."
+        )
+        allowed = []
+        for url in urls:
+            if self.host(url).breaker.allow():
+                allowed.append(url)
+            else:
+                skipped.inc(reason="circuit_open")
+                yield {"url": url, "text": None}
+
+        loop = asyncio.get_running_loop()
+        stop_at = None if self.deadline is None else loop.time() + self.deadline
+        missing = set(allowed)
+        pages = self.scraper.fetch_many(allowed)
+        try:
+            while missing:
+                timeout = None if stop_at is None else max(0, stop_at - loop.time())
+                try:
+                    page = await asyncio.wait_for(pages.__anext__(), timeout)
+                except (StopAsyncIteration, asyncio.TimeoutError):
+                    break
+                missing.discard(page["url"])
+                self.record(self.host(page["url"]), page)
+                yield page
+        finally:
+            await pages.aclose()  # type: ignore
+
+        if missing:
+            skipped.inc(len(missing), reason="deadline")
+        for url in allowed:
+            if url in missing:
+                self.host(url).breaker.cancel()
+                yield {"url": url, "text": None}
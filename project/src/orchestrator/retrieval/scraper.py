@@ -1,18 +1,82 @@
 from abc import ABC, abstractmethod
+import asyncio
+import json
+import os
 import re
-from typing import Any
+import time
+from typing import Any, AsyncGenerator
+from urllib.parse import urlparse
 
 import aiohttp
 from bs4 import BeautifulSoup
+from util import logger, metrics
+
+# Dominios con serie propia en scrape_seconds, separados por comas; el resto se agrupa en "other" para acotar la cardinalidad.
+METRIC_DOMAINS = frozenset(
+    domain.strip().lower()
+    for domain in os.environ.get("SCRAPE_METRIC_DOMAINS", "").split(",")
+    if domain.strip()
+)
+
+
+def domain_label(url: str) -> str:
+    """The domain of the url as a metric label, "other" unless it is in METRIC_DOMAINS."""
+
+    domain = urlparse(url).netloc.lower()
+    return domain if domain in METRIC_DOMAINS else "other"
+
+
+class TierThrottled(Exception):
+    """The scraper tier answered 429, the page can be retried after retry_after seconds."""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"Scraper tier busy, retry after {retry_after} seconds")
+        self.retry_after = retry_after
 
 
 # Esta clase de Python define un Scraper con un método abstracto fetch para obtener datos desde una URL y un método parse para extraer 
 # texto del contenido HTML.
 class Scraper(ABC):
+    # Un scraper por lotes resuelve fetch_many en una sola llamada en lugar de una por URL.
+    batched = False
+
     @abstractmethod
     async def fetch(self, url: str) -> dict[str, Any]:
         pass
 
+    async def fetch_many(self, urls: list[str]) -> AsyncGenerator[dict[str, Any], None]:
+        """Fetches the urls concurrently, yielding every page as soon as it is ready."""
+
+        tasks = [asyncio.create_task(self.timed_fetch(url)) for url in urls]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            # Closed early, e.g. the client went away: the pending pages are not fetched.
+            for task in tasks:
+                task.cancel()
+
+    async def timed_fetch(self, url: str) -> dict[str, Any]:
+        """Fetches the url recording its latency by domain."""
+
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            page = await self.fetch(url)
+            outcome = "ok" if page["text"] else "empty"
+            return page
+        except TierThrottled:
+            outcome = "throttled"
+            raise
+        finally:
+            metrics.histogram(
+                "scrape_seconds", "Latency of every scraped page by listed domain."
+            ).observe(
+                time.perf_counter() - start,
+                domain=domain_label(url),
+                outcome=outcome,
+            )
+
     async def parse(self, body):
         """Parses all the text from the html."""
 
@@ -27,19 +91,121 @@ class Scraper(ABC):
 
 
 class ScraperRemote(Scraper):
-    def __init__(self, host: str = "http://lb-scraper/scrape/?url=") -> None:
+    """Client of the scraper tier behind lb-scraper.
+
+    The HTTP session is shared so connections to the balancer are kept alive.
+    When every replica is busy the tier answers 429 with a Retry-After. fetch
+    raises TierThrottled with it, at most max_retry_after, and leaves the wait to
+    the caller, so that the ScrapeScheduler does not charge it to the host of the
+    page; a batch waits it out up to max_retries times before giving up.
+    fetch_many sends the urls to the batch endpoint, which renders them in one
+    request and streams back their text as each page finishes.
+    """
+
+    batched = True
+
+    def __init__(
+        self,
+        host: str = "http://lb-scraper/scrape/?url=",
+        batch_host: str = "http://lb-scraper/scrape/batch",
+        batch_size: int = 50,
+        max_retries: int = 2,
+        max_retry_after: float = 5,
+    ) -> None:
         self.host = host
+        self.batch_host = batch_host
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=60)
+            )
+        return self._session
 
     async def fetch(self, url: str) -> dict[str, Any]:
-        async with aiohttp.ClientSession() as session:
-            query_url = self.host + url
-            async with session.post(query_url) as response:
-                if response.status == 200:
-                    body = await response.json()
-                    text = await self.parse(body["html"])
-                    if text:
-                        return {"url": url, "text": text}
-            return {"url": url, "text": None}
+        throttled = metrics.counter(
+            "scraper_tier_throttled_total", "Scrapes answered with 429 by the tier."
+        )
+        async with self.session.post(self.host + url) as response:
+            if response.status == 200:
+                body = await response.json()
+                text = await self.parse(body["html"])
+                return {"url": url, "text": text or None, "status": 200}
+            if response.status == 429:
+                throttled.inc()
+                retry_after = float(response.headers.get("Retry-After", 1))
+                raise TierThrottled(min(retry_after, self.max_retry_after))
+        return {"url": url, "text": None}
+
+    async def fetch_many(self, urls: list[str]) -> AsyncGenerator[dict[str, Any], None]:
+        for i in range(0, len(urls), self.batch_size):
+            async for page in self.fetch_batch(urls[i : i + self.batch_size]):
+                yield page
+
+    async def fetch_batch(
+        self, urls: list[str]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """Streams the NDJSON results of one batch, the urls left unanswered get no text."""
+
+        throttled = metrics.counter(
+            "scraper_tier_throttled_total", "Scrapes answered with 429 by the tier."
+        )
+        latency = metrics.histogram(
+            "scrape_seconds", "Latency of every scraped page by listed domain."
+        )
+        missing = set(urls)
+        start = time.perf_counter()
+        try:
+            for attempt in range(self.max_retries + 1):
+                async with self.session.post(
+                    self.batch_host, json={"urls": urls, "text_only": True}
+                ) as response:
+                    if response.status == 200:
+                        async for line in response.content:
+                            if not line.strip():
+                                continue
+                            result = json.loads(line)
+                            missing.discard(result["url"])
+                            text = result.get("text") or None
+                            outcome = "ok" if text else "empty"
+                            latency.observe(
+                                time.perf_counter() - start,
+                                domain=domain_label(result["url"]),
+                                outcome="error" if "error" in result else outcome,
+                            )
+                            yield {
+                                "url": result["url"],
+                                "text": text,
+                                "status": result["status"],
+                            }
+                        break
+                    if response.status != 429:
+                        break
+                    throttled.inc(len(urls))
+                    if attempt == self.max_retries:
+                        break
+                    retry_after = float(response.headers.get("Retry-After", 1))
+                await asyncio.sleep(min(retry_after, self.max_retry_after))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # A broken stream keeps the pages already received.
+            logger.warning(
+                "Scrape batch failed",
+                extra={"stage": "scrape", "missing": len(missing), "error": e},
+            )
+
+        for url in urls:
+            if url in missing:
+                yield {"url": url, "text": None}
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
 
 # La clase ScraperLocal es una subclase de Scraper que define un método asincrónico fetch para obtener y analizar contenido HTML desde una 
 # URL dada utilizando aiohttp.
@@ -49,7 +215,9 @@ class ScraperLocal(Scraper):
             async with session.get(
                 url, timeout=aiohttp.ClientTimeout(total=5)
             ) as response:
+                if response.status >= 400:
+                    return {"url": url, "text": None, "status": response.status}
                 html = await response.text()
                 text = await self.parse(html)
 
-                return {"url": url, "text": text}
+                return {"url": url, "text": text, "status": response.status}
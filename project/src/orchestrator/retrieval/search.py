@@ -25,8 +25,9 @@ class Searcher(ABC):
 
 
 class GoogleAPI(Searcher):
-    def __init__(self) -> None:
+    def __init__(self, host: str = GOOGLE_API_URL) -> None:
         super().__init__()
+        self.host = host
 
     async def run(self, query: str) -> SearchResult:
         query_params = urlencode(
@@ -37,7 +38,7 @@ class GoogleAPI(Searcher):
                 "q": query,
             }
         )
-        url = f"{GOOGLE_API_URL}{query_params}"
+        url = f"{self.host}{query_params}"
 
         async with aiohttp.ClientSession() as session:
             async with session.get(
@@ -0,0 +1,168 @@
+# La clase TieredVectorCache antepone a una caché remota (Redis) un nivel caliente dentro del proceso con los chunks devueltos
+# recientemente, de modo que las consultas frecuentes se resuelven sin ir a la red.
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from models.chunk import Chunk
+from retrieval.cache import VectorDbCache
+from util import metrics
+
+
+class HotEntry:
+    __slots__ = ("document", "vector", "expires_at", "hits")
+
+    def __init__(self, document: Chunk, vector: np.ndarray, expires_at: float):
+        self.document = document
+        self.vector = vector
+        self.expires_at = expires_at
+        self.hits = 0
+
+
+class TieredVectorCache(VectorDbCache):
+    """Bounded in-process hot tier in front of a remote VectorDbCache.
+
+    A lookup is answered locally when the k-th local match is at least as similar
+    as confidence; otherwise it falls through to the remote cache and the returned
+    chunks are kept in the hot tier. Entries live at most local_ttl seconds and
+    are dropped as soon as the remote cache reports their key expired or deleted.
+    """
+
+    def __init__(
+        self,
+        remote: VectorDbCache,
+        max_items: int = 2048,
+        confidence: float = 0.9,
+        local_ttl: int = 600,
+        policy: str = "lru",
+    ) -> None:
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown eviction policy: {policy}")
+
+        self.remote = remote
+        self.max_items = max_items
+        self.confidence = confidence
+        self.local_ttl = local_ttl
+        self.policy = policy
+        self._entries: OrderedDict[str, HotEntry] = OrderedDict()
+        self._lock = threading.Lock()
+        self._index: Optional[tuple[list[str], np.ndarray]] = None
+
+    @staticmethod
+    def key_of(document: Chunk) -> str:
+        if document.key:
+            return document.key
+        return "chunks:" + hashlib.sha256(document.text.encode("utf-8")).hexdigest()
+
+    def _matrix(self) -> tuple[list[str], np.ndarray]:
+        """Stacks the hot vectors, rebuilt only after the tier changed."""
+
+        with self._lock:
+            if self._index is None:
+                keys = list(self._entries)
+                vectors = [self._entries[key].vector for key in keys]
+                matrix = (
+                    np.stack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+                )
+                self._index = (keys, matrix)
+            return self._index
+
+    def _find_local(self, vector: np.ndarray, k: int) -> list[Chunk]:
+        keys, matrix = self._matrix()
+        if len(keys) < k or matrix.shape[1] != len(vector):
+            return []
+
+        scores = matrix @ vector
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        if scores[top[-1]] < self.confidence:
+            return []
+
+        now = time.time()
+        documents = []
+        with self._lock:
+            for i in top:
+                entry = self._entries.get(keys[i])
+                if entry is None or entry.expires_at <= now:
+                    return []
+                entry.hits += 1
+                self._entries.move_to_end(keys[i])
+                documents.append(entry.document.with_similarity(float(scores[i])))
+        return documents
+
+    def _remember(self, documents: list[Chunk]):
+        expires_at = time.time() + self.local_ttl
+        with self._lock:
+            for document in documents:
+                key = self.key_of(document)
+                entry = self._entries.get(key)
+                if entry is None:
+                    vector = document.vector / (np.linalg.norm(document.vector) or 1)
+                    entry = HotEntry(document, vector, expires_at)
+                    self._entries[key] = entry
+                    self._index = None
+                entry.expires_at = expires_at
+                self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        now = time.time()
+        expired = [
+            key for key, entry in self._entries.items() if entry.expires_at <= now
+        ]
+        for key in expired:
+            del self._entries[key]
+
+        evicted = 0
+        while len(self._entries) > self.max_items:
+            if self.policy == "lru":
+                self._entries.popitem(last=False)
+            else:
+                key = min(self._entries, key=lambda key: self._entries[key].hits)
+                del self._entries[key]
+            evicted += 1
+
+        if expired or evicted:
+            self._index = None
+            metrics.counter(
+                "hot_tier_evictions_total", "Chunks dropped from the hot tier."
+            ).inc(len(expired) + evicted)
+        metrics.gauge("hot_tier_items", "Chunks held in the hot tier.").set(
+            len(self._entries)
+        )
+
+    def invalidate(self, key: str):
+        """Drops a chunk, called when the remote cache expires or deletes its key."""
+
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._index = None
+
+    async def find_similar(self, vector: list[float], k=10) -> list[Chunk]:
+        lookups = metrics.counter(
+            "tiered_cache_lookups_total", "Lookups by the tier that answered them."
+        )
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+
+        with metrics.span("hot_tier_knn", k=k):
+            documents = self._find_local(query, k)
+        if documents:
+            lookups.inc(tier="local")
+            return documents
+
+        lookups.inc(tier="remote")
+        documents = await self.remote.find_similar(vector, k)
+        self._remember(documents)
+        return documents
+
+    async def write(self, documents: list[Chunk]):
+        await self.remote.write(documents)
+
+    async def touch(self, documents: list[Chunk]):
+        # Chunks served by the hot tier count too, or Redis would expire the most popular ones.
+        await self.remote.touch(documents)
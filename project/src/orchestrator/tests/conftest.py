@@ -0,0 +1,33 @@
+# Configuración común de los tests: la API de Google se lee del entorno al importar retrieval, y los tests de Redis se saltan si no
+# hay un servidor en REDIS_HOST:REDIS_PORT.
+import os
+
+import pytest
+import redis
+
+for variable in (
+    "GOOGLE_API_HOST",
+    "GOOGLE_API_KEY",
+    "GOOGLE_CX",
+    "GOOGLE_FIELDS",
+    "HEADER_ACCEPT_ENCODING",
+    "HEADER_USER_AGENT",
+):
+    os.environ.setdefault(variable, "tests")
+
+REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+
+
+@pytest.fixture
+def redis_server():
+    """Host and port of a Redis Stack server, the test is skipped without one."""
+
+    client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, socket_connect_timeout=1)
+    try:
+        client.ping()
+    except redis.exceptions.ConnectionError:
+        pytest.skip(f"no Redis server at {REDIS_HOST}:{REDIS_PORT}")
+    finally:
+        client.close()
+    return REDIS_HOST, REDIS_PORT
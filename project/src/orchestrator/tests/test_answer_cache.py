@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+import redis
+
+from models.answer import Answer
+from retrieval.cache import RedisAnswerCache
+
+DIMENSION = 8
+
+
+@pytest.fixture
+def answer_cache(redis_server):
+    host, port = redis_server
+    cache = RedisAnswerCache(host=host, port=port, treshold=0.97, ttl=60)
+    try:
+        cache.client.ft("idx:answers_vss").dropindex(delete_documents=True)
+    except redis.exceptions.ResponseError:
+        pass
+    cache.init_index(DIMENSION)
+    yield cache
+    cache.client.ft("idx:answers_vss").dropindex(delete_documents=True)
+
+
+def test_find_returns_the_written_answer(answer_cache):
+    vector = [float(i + 1) for i in range(DIMENSION)]
+    answer = Answer(
+        query="what is a vector cache",
+        search="vector cache",
+        context="A cache of embeddings.",
+        tokens=["A ", "cache."],
+        vector=vector,
+        similarity=0,
+    )
+
+    asyncio.run(answer_cache.write(answer))
+    found = asyncio.run(answer_cache.find(vector))
+
+    assert found is not None
+    assert found.query == answer.query
+    assert found.tokens == answer.tokens
+    assert found.similarity == pytest.approx(1, abs=1e-4)
+
+
+def test_find_misses_a_dissimilar_query(answer_cache):
+    vector = [1.0] + [0.0] * (DIMENSION - 1)
+    other = [0.0] * (DIMENSION - 1) + [1.0]
+    answer = Answer(
+        query="q", search="s", context="c", tokens=[], vector=vector, similarity=0
+    )
+
+    asyncio.run(answer_cache.write(answer))
+
+    assert asyncio.run(answer_cache.find(other)) is None
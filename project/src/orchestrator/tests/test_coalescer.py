@@ -0,0 +1,28 @@
+import asyncio
+
+from util.coalescer import TokenCoalescer
+
+
+async def slow_tokens():
+    for text in ["a", "b", "c"]:
+        yield text
+    # The LLM stalls after a few tokens.
+    await asyncio.sleep(0.3)
+    yield "d"
+
+
+def test_pending_text_is_flushed_while_the_stream_stalls():
+    async def collect():
+        coalescer = TokenCoalescer(flush_interval=0.05, max_bytes=256)
+        start = asyncio.get_running_loop().time()
+        batches = []
+        async for text in coalescer.coalesce(slow_tokens()):
+            batches.append((text, asyncio.get_running_loop().time() - start))
+        return batches, coalescer.tokens
+
+    batches, tokens = asyncio.run(collect())
+
+    assert [text for text, _ in batches] == ["a", "bc", "d"]
+    # "bc" goes out after the interval, not when "d" arrives.
+    assert batches[1][1] < 0.2
+    assert tokens == 4
@@ -0,0 +1,40 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from ingest import Checkpoint, Ingestor
+from models.chunk import Chunk
+
+
+class DownCache:
+    async def write(self, documents):
+        raise ConnectionError("Redis is down")
+
+
+class PageScraper:
+    async def fetch(self, url):
+        return {"url": url, "text": "page"}
+
+
+async def embed_pages(pages):
+    return [
+        Chunk(text=page["text"], url=page["url"], vector=np.ones(4)) for page in pages
+    ]
+
+
+def test_run_fails_fast_when_the_cache_cannot_be_written():
+    retriever = SimpleNamespace(
+        cache=DownCache(), scraper=PageScraper(), embed_pages=embed_pages
+    )
+    ingestor = Ingestor(
+        retriever, Checkpoint(None), concurrency=2, batch_size=1  # type: ignore
+    )
+    items = (f"https://example.com/{i}" for i in range(100))
+
+    async def run():
+        await asyncio.wait_for(ingestor.run(items), timeout=5)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(run())
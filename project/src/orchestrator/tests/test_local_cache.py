@@ -0,0 +1,85 @@
+import asyncio
+
+import numpy as np
+
+from models.chunk import Chunk
+from retrieval.local_cache import LocalVectorCache
+
+DIMENSION = 4
+
+
+def chunk(text: str, *vector: float) -> Chunk:
+    return Chunk(url=f"https://example.com/{text}", text=text, vector=np.array(vector))
+
+
+def find(cache: LocalVectorCache, *vector: float, k: int = 10) -> list[Chunk]:
+    return asyncio.run(cache.find_similar(list(vector), k))
+
+
+def test_find_returns_the_most_similar_chunks_first():
+    cache = LocalVectorCache(DIMENSION)
+    asyncio.run(
+        cache.write(
+            [chunk("a", 1, 0, 0, 0), chunk("b", 0, 1, 0, 0), chunk("c", 1, 1, 0, 0)]
+        )
+    )
+
+    found = find(cache, 1, 0.1, 0, 0, k=2)
+
+    assert [doc.text for doc in found] == ["a", "c"]
+    assert found[0].similarity > found[1].similarity
+    assert len(cache) == 3
+
+
+def test_write_skips_duplicates_within_the_batch():
+    cache = LocalVectorCache(DIMENSION)
+
+    asyncio.run(
+        cache.write(
+            [chunk("a", 1, 0, 0, 0), chunk("b", 0, 1, 0, 0), chunk("a2", 2, 0, 0, 0)]
+        )
+    )
+
+    assert len(cache) == 2
+    assert {doc.text for doc in find(cache, 1, 1, 0, 0)} == {"a", "b"}
+
+
+def test_write_skips_duplicates_of_cached_chunks():
+    cache = LocalVectorCache(DIMENSION)
+    asyncio.run(cache.write([chunk("a", 1, 0, 0, 0)]))
+
+    asyncio.run(cache.write([chunk("a2", 1, 0.01, 0, 0), chunk("b", 0, 1, 0, 0)]))
+
+    assert len(cache) == 2
+    assert find(cache, 1, 0, 0, 0, k=1)[0].text == "a"
+
+
+def test_expired_chunks_are_not_found_and_their_rows_are_reused():
+    cache = LocalVectorCache(DIMENSION, ttl=0)
+    asyncio.run(cache.write([chunk("a", 1, 0, 0, 0)]))
+
+    assert find(cache, 1, 0, 0, 0) == []
+    assert len(cache) == 0
+
+    cache.ttl = 60
+    asyncio.run(cache.write([chunk("b", 0, 1, 0, 0)]))
+
+    assert [doc.text for doc in find(cache, 0, 1, 0, 0)] == ["b"]
+    assert cache._size == 1
+
+
+def test_reopening_the_memmap_keeps_the_chunks(tmp_path):
+    cache = LocalVectorCache(DIMENSION, path=str(tmp_path), capacity=2)
+    asyncio.run(
+        cache.write(
+            [chunk("a", 1, 0, 0, 0), chunk("b", 0, 1, 0, 0), chunk("c", 0, 0, 1, 0)]
+        )
+    )
+    cache.flush()
+
+    reopened = LocalVectorCache(DIMENSION, path=str(tmp_path), capacity=2)
+
+    assert reopened.capacity >= 3
+    assert len(reopened) == 3
+    found = find(reopened, 0, 0, 1, 0, k=1)[0]
+    assert (found.text, found.url) == ("c", "https://example.com/c")
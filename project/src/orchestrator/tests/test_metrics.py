@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+import threading
+
+from util.metrics import Metrics
+
+
+def test_render_while_labels_are_added():
+    metrics = Metrics()
+    counter = metrics.counter("requests_total", "Requests.")
+    histogram = metrics.histogram("latency_seconds", "Latency.", buckets=(1, 10))
+
+    def write():
+        for i in range(20000):
+            counter.inc(route=str(i))
+            histogram.observe(i % 20, route=str(i))
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    while writer.is_alive():
+        metrics.render()
+    writer.join()
+
+    text = metrics.render()
+    assert 'requests_total{route="0"} 1' in text
+    assert 'latency_seconds_bucket{route="0",le="+Inf"} 1' in text
+
+
+def test_render_shared_adds_the_workers_and_labels_live_gauges(tmp_path):
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    worker = Metrics()
+    worker.counter("requests_total", "Requests.").inc(2, route="a")
+    worker.gauge("inflight", "Inflight.").set(5)
+    worker.histogram("latency_seconds", "Latency.", buckets=(1, 10)).observe(5)
+    worker.write_snapshot(str(tmp_path))
+    os.replace(tmp_path / f"{os.getpid()}.json", tmp_path / f"{exited.pid}.json")
+
+    metrics = Metrics()
+    metrics.counter("requests_total", "Requests.").inc(3, route="a")
+    metrics.gauge("inflight", "Inflight.").set(1)
+    metrics.histogram("latency_seconds", "Latency.", buckets=(1, 10)).observe(0.5)
+
+    text = metrics.render_shared(str(tmp_path))
+    assert 'requests_total{route="a"} 5' in text
+    assert 'latency_seconds_bucket{le="1"} 1' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 2' in text
+    assert "latency_seconds_sum 5.5" in text
+    # The gauge of the exited worker is dropped, the live one is labelled.
+    assert f'inflight{{worker="{os.getpid()}"}} 1' in text
+    assert f'worker="{exited.pid}"' not in text
@@ -0,0 +1,18 @@
+import numpy as np
+
+from models.chunk import Chunk
+from retrieval.packer import ContextPacker
+
+
+def test_higher_diversity_prefers_chunks_unlike_the_picked_ones():
+    documents = [
+        Chunk("best", "https://a", np.array([1.0, 0.0]), similarity=0.9),
+        Chunk("similar", "https://b", np.array([0.9, 0.436]), similarity=0.85),
+        Chunk("different", "https://c", np.array([0.0, 1.0]), similarity=0.6),
+    ]
+
+    relevant, _ = ContextPacker(diversity=0.1).mmr_order(documents)
+    diverse, _ = ContextPacker(diversity=0.9).mmr_order(documents)
+
+    assert relevant == [0, 1, 2]
+    assert diverse == [0, 2, 1]
@@ -0,0 +1,172 @@
+import asyncio
+import json
+from typing import Any
+
+import numpy as np
+
+from models.chunk import Chunk
+from models.search import SearchDoc, SearchResult
+from retrieval.local_cache import LocalVectorCache
+from retrieval.retriever import Retriever, background_fills, filling_urls
+from retrieval.embeddings import Embeddings
+from retrieval.scraper import Scraper
+from retrieval.search import Searcher
+from retrieval.splitter import Splitter
+from util.admission import AdmissionController
+
+DIMENSION = 4
+
+
+def cache_only_events(cache, vector):
+    retriever = Retriever(
+        cache=cache,
+        searcher=None,  # type: ignore
+        scraper=None,  # type: ignore
+        embeddings=None,  # type: ignore
+        splitter=None,  # type: ignore
+        admission=AdmissionController(),
+    )
+
+    async def collect():
+        return [
+            event
+            async for event in retriever.get_context(
+                query="q",
+                doc_treshold=0.85,
+                query_vector=vector,
+                cache_only=True,
+            )
+        ]
+
+    return asyncio.run(collect())
+
+
+def test_cache_only_without_documents_yields_no_cached_answer():
+    events = cache_only_events(LocalVectorCache(DIMENSION), [1.0, 0.0, 0.0, 0.0])
+
+    names = [event["event"] for event in events]
+    assert "context" not in names
+    assert names[-1] == "no_cached_answer"
+    assert json.loads(events[-1]["data"])["retry_after"] >= 1
+
+
+def test_cache_only_with_documents_yields_the_context():
+    cache = LocalVectorCache(DIMENSION)
+    vector = np.array([1.0, 0.0, 0.0, 0.0], dtype=np.float32)
+    asyncio.run(
+        cache.write([Chunk(url="https://example.com", text="cached", vector=vector)])
+    )
+
+    events = cache_only_events(cache, vector.tolist())
+
+    names = [event["event"] for event in events]
+    assert "no_cached_answer" not in names
+    assert events[-1] == {"event": "context", "data": "cached"}
+
+
+class BlockedScraper(Scraper):
+    """Scraper whose pages stay pending until released."""
+
+    def __init__(self) -> None:
+        self.fetched: list[str] = []
+        self.release = asyncio.Event()
+
+    async def fetch(self, url: str) -> dict[str, Any]:
+        self.fetched.append(url)
+        await self.release.wait()
+        return {"url": url, "text": ""}
+
+
+def results(*urls: str) -> SearchResult:
+    return SearchResult(items=[SearchDoc(link=url) for url in urls])
+
+
+def test_background_fills_are_deduplicated_by_url_and_capped():
+    scraper = BlockedScraper()
+    retriever = Retriever(
+        cache=LocalVectorCache(DIMENSION),
+        searcher=None,  # type: ignore
+        scraper=scraper,
+        embeddings=None,  # type: ignore
+        splitter=None,  # type: ignore
+        max_background_fills=2,
+    )
+    vector = [1.0, 0.0, 0.0, 0.0]
+
+    async def run():
+        retriever.fill_in_background(vector, results("https://a", "https://b"), 10)
+        # Only the url nobody is filling yet is scraped again.
+        retriever.fill_in_background(vector, results("https://b", "https://c"), 10)
+        retriever.fill_in_background(vector, results("https://a"), 10)
+        # Two fills are running, a third one is dropped.
+        retriever.fill_in_background(vector, results("https://d"), 10)
+        await asyncio.sleep(0)
+        assert len(background_fills) == 2
+        assert sorted(filling_urls) == ["https://a", "https://b", "https://c"]
+
+        scraper.release.set()
+        await asyncio.wait(background_fills)
+
+    asyncio.run(run())
+
+    assert sorted(scraper.fetched) == ["https://a", "https://b", "https://c"]
+    assert not background_fills and not filling_urls
+
+
+class VectorEmbeddings(Embeddings):
+    def __init__(self, vectors: dict[str, list[float]]) -> None:
+        self.vectors = vectors
+
+    async def run(self, chunks: list[str]) -> list[list[float]]:
+        return [self.vectors[chunk] for chunk in chunks]
+
+
+class LineSplitter(Splitter):
+    async def split(self, text: str) -> list[str]:
+        return text.split("\n")
+
+
+class OneResultSearcher(Searcher):
+    async def run(self, query: str) -> SearchResult:
+        return results("https://fetched")
+
+
+class TextScraper(Scraper):
+    async def fetch(self, url: str) -> dict[str, Any]:
+        return {"url": url, "text": "strong\nstronger", "status": 200}
+
+
+def test_partial_hit_keeps_the_best_k_of_cached_and_fetched():
+    cache = LocalVectorCache(2)
+    asyncio.run(
+        cache.write(
+            [Chunk(url="https://cached", text="weak", vector=np.array([0.9, 0.436]))]
+        )
+    )
+    retriever = Retriever(
+        cache=cache,
+        searcher=OneResultSearcher(),
+        scraper=TextScraper(),
+        embeddings=VectorEmbeddings(
+            {"strong": [0.98, 0.199], "stronger": [0.99, 0.141]}
+        ),
+        splitter=LineSplitter(),
+    )
+
+    async def collect():
+        return [
+            event
+            async for event in retriever.get_context(
+                query="q",
+                cache_treshold=0.95,
+                k=2,
+                doc_treshold=0.85,
+                query_vector=[1.0, 0.0],
+            )
+        ]
+
+    context = asyncio.run(collect())[-1]
+
+    assert context["event"] == "context"
+    assert "weak" not in context["data"]
+    assert "strong" in context["data"] and "stronger" in context["data"]
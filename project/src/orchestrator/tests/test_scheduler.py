@@ -0,0 +1,104 @@
+import asyncio
+import time
+from typing import Any
+
+from retrieval.scheduler import ScrapeScheduler
+from retrieval.scraper import Scraper, TierThrottled
+
+
+class ThrottledScraper(Scraper):
+    """Answers throttled times with a busy tier before returning the page."""
+
+    def __init__(self, throttled: int, retry_after: float) -> None:
+        self.throttled = throttled
+        self.retry_after = retry_after
+        self.calls = 0
+
+    async def fetch(self, url: str) -> dict[str, Any]:
+        self.calls += 1
+        if self.calls <= self.throttled:
+            raise TierThrottled(self.retry_after)
+        return {"url": url, "text": "page"}
+
+
+def test_tier_retry_after_is_waited_outside_the_host_timeout():
+    scraper = ThrottledScraper(throttled=2, retry_after=0.05)
+    # The Retry-After waits add up to more than the host timeout.
+    scheduler = ScrapeScheduler(scraper, min_timeout=0.02, max_timeout=0.02)
+
+    page = asyncio.run(scheduler.fetch("https://example.com/a"))
+
+    assert page["text"] == "page"
+    assert scraper.calls == 3
+    assert scheduler._hosts["example.com"].breaker.failures == 0
+
+
+def test_a_throttled_tier_does_not_open_the_host_breaker():
+    scraper = ThrottledScraper(throttled=100, retry_after=0)
+    scheduler = ScrapeScheduler(scraper, failure_threshold=2, tier_retries=1)
+
+    async def run():
+        return [await scheduler.fetch("https://example.com/a") for _ in range(3)]
+
+    pages = asyncio.run(run())
+
+    assert [page["text"] for page in pages] == [None, None, None]
+    assert scraper.calls == 6
+    breaker = scheduler._hosts["example.com"].breaker
+    assert breaker.failures == 0 and breaker.allow()
+
+
+class PageScraper(Scraper):
+    async def fetch(self, url: str) -> dict[str, Any]:
+        return {"url": url, "text": "page", "status": 200}
+
+
+def test_idle_hosts_with_a_closed_breaker_are_pruned():
+    scheduler = ScrapeScheduler(PageScraper(), failure_threshold=1, idle_after=60)
+
+    async def run():
+        await scheduler.fetch("https://idle.example.com/a")
+        await scheduler.fetch("https://blocked.example.com/a")
+
+    asyncio.run(run())
+    scheduler._hosts["blocked.example.com"].breaker.failure()
+    busy = scheduler.host("https://busy.example.com/a")
+    busy.active = 1
+    for host in scheduler._hosts.values():
+        host.last_used -= 120
+
+    scheduler.prune(time.monotonic())
+
+    assert set(scheduler._hosts) == {"blocked.example.com", "busy.example.com"}
+
+
+class BatchedScraper(Scraper):
+    """Batched scraper answering each url with the next of the given results."""
+
+    batched = True
+
+    def __init__(self, results: list[dict[str, Any]]) -> None:
+        self.results = results
+
+    async def fetch(self, url: str) -> dict[str, Any]:
+        raise NotImplementedError
+
+    async def fetch_many(self, urls: list[str]):
+        for url in urls:
+            yield {"url": url, **self.results.pop(0)}
+
+
+def test_tier_misses_do_not_reset_the_breaker_in_batched_mode():
+    timeout = {"text": None, "status": 408, "error": "Not fast enough"}
+    lost = {"text": None}
+    scraper = BatchedScraper([timeout, lost, {"text": None, "status": 502}, lost])
+    scheduler = ScrapeScheduler(scraper, failure_threshold=2)
+
+    async def run():
+        for _ in range(4):
+            async for _ in scheduler.fetch_many(["https://example.com/a"]):
+                pass
+
+    asyncio.run(run())
+
+    assert not scheduler._hosts["example.com"].breaker.allow()
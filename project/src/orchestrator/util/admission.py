@@ -0,0 +1,166 @@
+# La clase AdmissionController decide qué requests entran al pipeline: un número fijo se atiende a la vez, el resto espera en una cola
+# acotada y con tiempo máximo, y lo que no cabe se rechaza enseguida con un Retry-After. Bajo presión las requests admitidas se marcan
+# como degradadas para responder solo desde la caché, y cada etapa del pipeline (embeddings, raspado, LLM) tiene su propio límite.
+import asyncio
+from contextlib import asynccontextmanager
+import time
+from typing import AsyncIterator, Optional
+
+from util.metrics import metrics
+
+
+class Rejected(Exception):
+    """A request shed by the admission controller, with the HTTP status and Retry-After to answer."""
+
+    def __init__(self, status: int, reason: str, retry_after: int) -> None:
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """The slot of an admitted request; release can be called more than once."""
+
+    __slots__ = ("controller", "degraded", "start", "released")
+
+    def __init__(self, controller: "AdmissionController", degraded: bool) -> None:
+        self.controller = controller
+        self.degraded = degraded
+        self.start = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(self)
+
+
+class AdmissionController:
+    """Limits the requests in flight, queues a bounded number and sheds the rest.
+
+    Up to max_requests run at once. Up to max_queue more wait at most max_wait
+    seconds for a slot; a full queue is answered with 429 and a wait that times
+    out with 503. A request that had to queue, or admitted with more than
+    degrade_at of the slots busy, is degraded. Stages listed in stage_limits
+    run at most that many at once across requests.
+    """
+
+    def __init__(
+        self,
+        max_requests: int = 32,
+        max_queue: int = 64,
+        max_wait: float = 5.0,
+        degrade_at: float = 0.75,
+        stage_limits: Optional[dict[str, int]] = None,
+    ) -> None:
+        self.max_requests = max_requests
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.degrade_at = degrade_at
+        self.stage_limits = stage_limits or {}
+        self.inflight = 0
+        self.waiting = 0
+        # Moving average of the request duration, to estimate the Retry-After.
+        self.average_seconds = 5.0
+        # Semaphores are created lazily, inside the event loop that uses them.
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._stages: dict[str, asyncio.Semaphore] = {}
+
+    @staticmethod
+    def parse_limits(value: str) -> dict[str, int]:
+        """Parses "embedding=16,scrape=8,llm=16"."""
+
+        limits = {}
+        for item in filter(None, (part.strip() for part in value.split(","))):
+            stage, limit = item.split("=")
+            limits[stage.strip()] = int(limit)
+        return limits
+
+    def retry_after(self) -> int:
+        # One slot frees up on average every average_seconds / max_requests seconds.
+        queued = self.waiting + 1
+        return max(1, round(self.average_seconds * queued / self.max_requests))
+
+    async def admit(self) -> Ticket:
+        """Waits for a slot, raising Rejected when the queue is full or the wait too long."""
+
+        shed = metrics.counter(
+            "admission_shed_total", "Requests rejected by the admission controller."
+        )
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_requests)
+
+        queued = self._slots.locked()
+        if queued:
+            if self.waiting >= self.max_queue:
+                shed.inc(reason="queue_full")
+                raise Rejected(429, "queue_full", self.retry_after())
+
+            self.waiting += 1
+            self._set_depth()
+            start = time.monotonic()
+            try:
+                async with asyncio.timeout(self.max_wait):
+                    await self._slots.acquire()
+            except TimeoutError:
+                shed.inc(reason="queue_timeout")
+                raise Rejected(503, "queue_timeout", self.retry_after())
+            finally:
+                self.waiting -= 1
+                self._set_depth()
+            metrics.histogram(
+                "admission_wait_seconds", "Time admitted requests spent queued."
+            ).observe(time.monotonic() - start)
+        else:
+            await self._slots.acquire()
+
+        self.inflight += 1
+        self._set_depth()
+        degraded = queued or self.inflight > self.degrade_at * self.max_requests
+        if degraded:
+            metrics.counter(
+                "admission_degraded_total", "Requests admitted in degraded mode."
+            ).inc()
+        return Ticket(self, degraded)
+
+    def release(self, ticket: Ticket):
+        elapsed = time.monotonic() - ticket.start
+        self.average_seconds = 0.8 * self.average_seconds + 0.2 * elapsed
+        self.inflight -= 1
+        self._set_depth()
+        self._slots.release()  # type: ignore
+
+    def _set_depth(self):
+        metrics.gauge("admission_inflight", "Requests being served.").set(
+            self.inflight
+        )
+        metrics.gauge(
+            "admission_queue_depth", "Requests waiting for an admission slot."
+        ).set(self.waiting)
+
+    @asynccontextmanager
+    async def stage(self, name: str) -> AsyncIterator[None]:
+        """Holds one of the slots of the stage, if it is limited."""
+
+        limit = self.stage_limits.get(name)
+        if limit is None:
+            yield
+            return
+
+        semaphore = self._stages.get(name)
+        if semaphore is None:
+            semaphore = self._stages[name] = asyncio.Semaphore(limit)
+        inflight = metrics.gauge(
+            "admission_stage_inflight", "Pipeline stages running by stage."
+        )
+        start = time.monotonic()
+        async with semaphore:
+            metrics.histogram(
+                "admission_stage_wait_seconds", "Time waited for a stage slot."
+            ).observe(time.monotonic() - start, stage=name)
+            inflight.inc(stage=name)
+            try:
+                yield
+            finally:
+                inflight.dec(stage=name)
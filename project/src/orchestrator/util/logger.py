@@ -1,32 +1,145 @@
-LOG_LEVEL: str = "DEBUG"
-FORMAT: str = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-logging_config = {
-    "version": 1,  # mandatory field
-    # if you want to overwrite existing loggers' configs
-    # "disable_existing_loggers": False,
-    "formatters": {
-        "basic": {
-            "format": FORMAT,
-        }
-    },
-    "handlers": {
-        "console": {
-            "formatter": "basic",
-            "class": "logging.StreamHandler",
-            "stream": "ext://sys.stderr",
-            "level": LOG_LEVEL,
-        }
-    },
-    "loggers": {
-        "simple_example": {
-            "handlers": ["console"],
-            "level": LOG_LEVEL,
-            # "propagate": False
-        }
-    },
-}
-
+# Logging del orquestador fuera del event loop: los registros se encolan en el hilo que los emite y un QueueListener los formatea y
+# escribe en un hilo aparte, así una escritura lenta a stderr no frena las requests. Cada línea lleva sus campos como key=value y el
+# trace id de la request; las líneas muy frecuentes pasan por un logger muestreado.
+import atexit
+import json
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import random
+from typing import Optional
+
+from util.metrics import metrics
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Fracción de las líneas de sampled_logger que se escriben.
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 0.1))
+# Registros pendientes como máximo; con la cola llena se descartan en lugar de bloquear.
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+# Attributes every LogRecord has, anything else was passed as a field in extra.
+RESERVED = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+
+logger = logging.getLogger("orchestrator")
+# For lines emitted per page or per chunk, only LOG_SAMPLE_RATE of them are kept.
+sampled_logger = logger.getChild("sampled")
+
+
+def _value(value) -> str:
+    if isinstance(value, float):
+        value = f"{value:.6g}"
+    value = str(value)
+    if not value or any(c in value for c in ' ="\n'):
+        return json.dumps(value)
+    return value
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Formats a record as time, level, logger and message followed by its fields as key=value."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = " ".join(
+            f"{key}={_value(value)}"
+            for key, value in record.__dict__.items()
+            if key not in RESERVED
+        )
+        line = (
+            f"{self.formatTime(record)} {record.levelname} {record.name} "
+            f"msg={_value(record.getMessage())} {fields}"
+        ).rstrip()
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class ContextFilter(logging.Filter):
+    """Adds the trace id of the request being served, it must run in the emitting task."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "trace_id"):
+            trace_id = metrics.current_trace_id()
+            if trace_id is not None:
+                record.trace_id = trace_id
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a share of the records, warnings and errors are always kept."""
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or random.random() < self.rate:
+            return True
+        metrics.counter(
+            "log_records_dropped_total", "Log records not written by reason."
+        ).inc(reason="sampled")
+        return False
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """Enqueues records without formatting them and drops them when the queue is full.
+
+    The queue never leaves the process, so the message is formatted by the
+    listener thread instead of the emitting one.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.counter(
+                "log_records_dropped_total", "Log records not written by reason."
+            ).inc(reason="queue_full")
+
+
+class BackgroundQueueListener(QueueListener):
+    def enqueue_sentinel(self):
+        # Waits for room, a full queue must not make the stop fail.
+        self.queue.put(self._sentinel)
+
+
+def offload(target: logging.Logger, queue_size: int = LOG_QUEUE_SIZE):
+    """Moves the handlers of the logger to a listener thread, behind a bounded queue.
+
+    The listener is stopped at exit, writing the records still queued.
+    """
+
+    records: queue.Queue = queue.Queue(queue_size)
+    listener = BackgroundQueueListener(
+        records, *target.handlers, respect_handler_level=True
+    )
+    handler = BackgroundQueueHandler(records)
+    handler.addFilter(ContextFilter())
+    target.handlers = [handler]
+    listener.start()
+    atexit.register(listener.stop)
+
+
+def setup_logging(
+    level: str = LOG_LEVEL,
+    sample_rate: float = LOG_SAMPLE_RATE,
+    access_log: Optional[logging.Logger] = None,
+):
+    """Logs the orchestrator as key=value lines to stderr from a background thread.
+
+    The handlers of access_log, e.g. the uvicorn access log, are moved to a
+    background thread too.
+    """
+
+    console = logging.StreamHandler()
+    console.setFormatter(KeyValueFormatter())
+    logger.handlers = [console]
+    logger.setLevel(level)
+    logger.propagate = False
+    sampled_logger.filters = [SamplingFilter(sample_rate)]
 
-# create logger
-logger = logging.getLogger("uvicorn")
+    offload(logger)
+    if access_log is not None and access_log.handlers:
+        offload(access_log)
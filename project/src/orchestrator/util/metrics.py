@@ -0,0 +1,359 @@
+# Registro de métricas en proceso (histogramas, contadores y gauges) y trazas por request. Las métricas se exponen en formato
+# Prometheus en /metrics y los spans se envían a un exporter intercambiable, que por defecto no hace nada.
+from abc import ABC, abstractmethod
+import atexit
+from contextlib import contextmanager
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from typing import Iterator, Optional
+import uuid
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_trace_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "trace_id", default=None
+)
+_span_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "span_id", default=None
+)
+
+
+def _label_key(labels: dict[str, str]) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            values = [[list(key), value] for key, value in self._values.items()]
+        return {"name": self.name, "help": self.help, "values": values}
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        # Copied under the lock: a label added while rendering would change the dict size.
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._counts: dict[tuple, list[int]] = {}
+        self._sums: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    def count(self, **labels) -> int:
+        counts = self._counts.get(_label_key(labels))
+        return counts[-1] if counts else 0
+
+    def merge(self, key: tuple, counts: list[int], total: float) -> None:
+        """Adds the buckets and sum of a series observed elsewhere."""
+
+        with self._lock:
+            own = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            for i, count in enumerate(counts):
+                own[i] += count
+            self._sums[key] = self._sums.get(key, 0) + total
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            values = [
+                [list(key), list(counts), self._sums[key]]
+                for key, counts in self._counts.items()
+            ]
+        return {
+            "name": self.name,
+            "help": self.help,
+            "buckets": list(self.buckets),
+            "values": values,
+        }
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        # The buckets and sum of a series are copied together, so they stay consistent.
+        with self._lock:
+            series = [
+                (key, list(counts), self._sums[key])
+                for key, counts in self._counts.items()
+            ]
+        for key, counts, total in series:
+            for bound, count in zip(self.buckets, counts):
+                le = _format_labels(key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {count}")
+            le = _format_labels(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {counts[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {counts[-1]}")
+        return lines
+
+
+class Span:
+    def __init__(
+        self, name: str, trace_id: Optional[str], parent_id: Optional[str], **attributes
+    ) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.duration = 0.0
+
+
+# La clase SpanExporter define el destino de los spans terminados, de modo que las trazas puedan enviarse a cualquier backend.
+class SpanExporter(ABC):
+    @abstractmethod
+    def export(self, span: Span) -> None:
+        pass
+
+
+class NoopExporter(SpanExporter):
+    """Discards the spans, only the metrics are kept."""
+
+    def export(self, span: Span) -> None:
+        pass
+
+
+class LogExporter(SpanExporter):
+    """Writes every finished span as a log line."""
+
+    def __init__(self, logger: logging.Logger) -> None:
+        self.logger = logger
+
+    def export(self, span: Span) -> None:
+        self.logger.info(
+            "Span",
+            extra={
+                "span": span.name,
+                "trace_id": span.trace_id,
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "duration": span.duration,
+                **span.attributes,
+            },
+        )
+
+
+class Metrics:
+    """Holds the metrics of the process and creates the trace spans."""
+
+    def __init__(self, exporter: Optional[SpanExporter] = None) -> None:
+        self.exporter = exporter or NoopExporter()
+        self._metrics: dict[str, Counter | Histogram] = {}
+        self._lock = threading.Lock()
+        self.stages = self.histogram(
+            "pipeline_stage_seconds", "Duration of every pipeline stage."
+        )
+
+    def _register(self, metric_class, name: str, help: str, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_class(name, help, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._register(Gauge, name, help)
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, buckets=buckets)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> str:
+        """Starts a trace in the current context, the spans opened after it share its id.
+
+        Every request is served in its own task, so the trace is never reset: it
+        ends with the task, which makes it safe to start from async generators.
+        """
+
+        trace_id = trace_id or uuid.uuid4().hex
+        _trace_id.set(trace_id)
+        return trace_id
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        """Times a stage, records it in the stage histogram and exports the span.
+
+        The span must not enclose a yield of an async generator, use record instead.
+        """
+
+        span = Span(name, _trace_id.get(), _span_id.get(), **attributes)
+        token = _span_id.set(span.span_id)
+        try:
+            yield span
+        finally:
+            _span_id.reset(token)
+            span.duration = time.perf_counter() - span.start
+            self.stages.observe(span.duration, stage=name)
+            self.exporter.export(span)
+
+    def record(self, name: str, start: float, **attributes) -> float:
+        """Records a stage that started at start, for stages that cannot be wrapped in a span."""
+
+        span = Span(name, _trace_id.get(), _span_id.get(), **attributes)
+        span.start = start
+        span.duration = time.perf_counter() - start
+        self.stages.observe(span.duration, stage=name)
+        self.exporter.export(span)
+        return span.duration
+
+    def current_trace_id(self) -> Optional[str]:
+        return _trace_id.get()
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text format."""
+
+        lines = []
+        with self._lock:
+            registered = list(self._metrics.values())
+        for metric in registered:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict[str, list[dict]]:
+        """The values of every metric by type, as plain data."""
+
+        with self._lock:
+            registered = list(self._metrics.values())
+        snapshot: dict[str, list[dict]] = {"counter": [], "gauge": [], "histogram": []}
+        for metric in registered:
+            kind = (
+                "gauge"
+                if isinstance(metric, Gauge)
+                else "counter" if isinstance(metric, Counter) else "histogram"
+            )
+            snapshot[kind].append(metric.snapshot())
+        return snapshot
+
+    def write_snapshot(self, directory: str):
+        """Writes the snapshot of this process to directory/<pid>.json atomically."""
+
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        os.replace(path + ".tmp", path)
+
+    def share(self, directory: str, interval: float = 5.0):
+        """Writes the snapshot of this process to directory every interval seconds and at exit."""
+
+        os.makedirs(directory, exist_ok=True)
+
+        def run():
+            while True:
+                try:
+                    self.write_snapshot(directory)
+                except OSError as e:
+                    logging.getLogger("orchestrator").warning(
+                        "Metrics snapshot failed", extra={"error": e}
+                    )
+                time.sleep(interval)
+
+        threading.Thread(target=run, name="metrics-snapshot", daemon=True).start()
+        atexit.register(self.write_snapshot, directory)
+
+    def render_shared(self, directory: str) -> str:
+        """Renders the metrics of every process that shares directory.
+
+        Counters and histograms are added across the snapshots of every process
+        ever started, so a restarted worker does not make them go back. Gauges
+        are only taken from live processes, labelled with their pid as worker.
+        The snapshot of this process is written first, the others are at most
+        one share interval old.
+        """
+
+        self.write_snapshot(directory)
+        merged = Metrics()
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".json"):
+                continue
+            pid = int(name[: -len(".json")])
+            try:
+                with open(os.path.join(directory, name)) as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+            except (OSError, ValueError):
+                continue
+
+            for entry in snapshot["counter"]:
+                counter = merged.counter(entry["name"], entry["help"])
+                for key, value in entry["values"]:
+                    counter.inc(value, **dict(key))
+            if _alive(pid):
+                for entry in snapshot["gauge"]:
+                    gauge = merged.gauge(entry["name"], entry["help"])
+                    for key, value in entry["values"]:
+                        gauge.set(value, **dict(key), worker=str(pid))
+            for entry in snapshot["histogram"]:
+                histogram = merged.histogram(
+                    entry["name"], entry["help"], buckets=entry["buckets"]
+                )
+                for key, counts, total in entry["values"]:
+                    histogram.merge(_label_key(dict(key)), counts, total)
+        return merged.render()
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+metrics = Metrics()
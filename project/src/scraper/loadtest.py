@@ -0,0 +1,83 @@
+# Prueba de carga del nivel de raspado: lanza requests concurrentes contra lb-scraper y reporta códigos de respuesta, percentiles de
+# latencia y throughput. Con todas las réplicas saturadas el balanceador devuelve 429 con Retry-After.
+#
+#   docker compose up -d --scale scraper=4 lb-scraper
+#   python loadtest.py --concurrency 32 --requests 400
+import argparse
+import asyncio
+from collections import Counter
+import statistics
+import time
+
+import aiohttp
+
+DEFAULT_PAGES = [
+    "https://example.com",
+    "https://www.python.org",
+    "https://redis.io",
+    "https://en.wikipedia.org/wiki/Web_scraping",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test of the scraper tier.")
+    parser.add_argument("--host", default="http://localhost:8080/scrape?url=")
+    parser.add_argument("--pages", default=None, help="File with one URL per line.")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=30)
+    return parser.parse_args()
+
+
+async def main(args):
+    pages = DEFAULT_PAGES
+    if args.pages:
+        with open(args.pages) as lines:
+            pages = [line.strip() for line in lines if line.strip()]
+
+    statuses: Counter = Counter()
+    latencies: list[float] = []
+    retry_after: list[float] = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+
+        async def scrape(i: int):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    async with session.post(
+                        args.host + pages[i % len(pages)]
+                    ) as response:
+                        await response.read()
+                        statuses[response.status] += 1
+                        if response.status == 429:
+                            retry_after.append(
+                                float(response.headers.get("Retry-After", 0))
+                            )
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    statuses[type(e).__name__] += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[scrape(i) for i in range(args.requests)])
+        elapsed = time.perf_counter() - start
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{args.requests} requests, concurrency {args.concurrency}, {elapsed:.1f}s")
+    print(f"throughput {args.requests / elapsed:.1f} req/s")
+    print(
+        f"latency p50 {quantiles[49]:.2f}s p90 {quantiles[89]:.2f}s "
+        f"p99 {quantiles[98]:.2f}s max {max(latencies):.2f}s"
+    )
+    print(
+        "status "
+        + ", ".join(f"{status}: {count}" for status, count in statuses.items())
+    )
+    if retry_after:
+        print(f"mean Retry-After {statistics.mean(retry_after):.1f}s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
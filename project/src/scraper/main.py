@@ -11,15 +11,33 @@ navegará a la URL especificada y devolverá el HTML.
 dada utilizando Playwright y aiohttp. Cuando se realiza una solicitud POST al endpoint "/scrape" con un parámetro URL, la aplicación intentará 
 hacer scraping del contenido HTML de la URL proporcionada usando un navegador Firefox sin interfaz gráfica lanzado por Playwright.
 """
-from fastapi import FastAPI, HTTPException
+import asyncio
+import json
+import os
+import re
+import zlib
+from bs4 import BeautifulSoup
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from playwright.async_api import async_playwright
 from playwright._impl._api_types import TimeoutError
+from pydantic import BaseModel
 from contextlib import asynccontextmanager
 import logging
 import aiohttp
 
 logger = logging.getLogger(__name__)
-app = FastAPI()
+
+# Raspados simultáneos que admite cada réplica; por encima responde 429 para que el balanceador pruebe otra réplica.
+MAX_INFLIGHT = int(os.environ.get("SCRAPER_MAX_INFLIGHT", 8))
+# Cada página que se renderiza ocupa un lugar, tanto las de /scrape como las de un lote.
+slots = asyncio.Semaphore(MAX_INFLIGHT)
+inflight = 0
+# Media móvil de la duración de un raspado, para estimar el Retry-After.
+average_seconds = 2.0
+# Páginas de un mismo lote que se renderizan a la vez, y tamaño máximo del lote.
+BATCH_CONCURRENCY = int(os.environ.get("SCRAPER_BATCH_CONCURRENCY", 4))
+MAX_BATCH_SIZE = int(os.environ.get("SCRAPER_MAX_BATCH_SIZE", 50))
 
 
 async def fetch_check_js(url):
@@ -42,23 +60,156 @@ async def launch_browser():
             await browser.close()
 
 
-async def scrape_with_browser(url: str):
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Un solo navegador por réplica; cada raspado abre su propio contexto aislado.
     async with launch_browser() as browser:
-        page = await browser.new_page()
-        await page.goto(url, timeout=2000)
+        app.state.browser = browser
+        yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+async def scrape_with_browser(url: str) -> tuple[str, int]:
+    context = await app.state.browser.new_context()
+    try:
+        page = await context.new_page()
+        response = await page.goto(url, timeout=2000)
         html = await page.content()
-    return html
+    finally:
+        await context.close()
+    return html, response.status if response is not None else 200
+
+
+def extract_text(html: str) -> str:
+    soup = BeautifulSoup(html, "html.parser")
+    raw_text = soup.get_text(separator=" ", strip=True)
+    return re.sub(r"\n{3,}|\s{2,}", "\n", raw_text)
+
+
+@asynccontextmanager
+async def tracked():
+    """Holds a slot while a page is scraped and updates the average scrape time."""
+
+    global inflight, average_seconds
+    await slots.acquire()
+    inflight += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        inflight -= 1
+        slots.release()
+        average_seconds = 0.8 * average_seconds + 0.2 * (time.perf_counter() - start)
+
+
+@app.middleware("http")
+async def limit_inflight(request, call_next):
+    """Rejects scrapes with 429 and a Retry-After once MAX_INFLIGHT are running.
+
+    A single scrape takes its slot here, before anything is awaited, so a burst
+    cannot pass the check together. The pages of an accepted batch wait for a
+    slot each, then render at most MAX_INFLIGHT pages with the other requests.
+    """
+
+    if not request.url.path.startswith("/scrape"):
+        return await call_next(request)
+
+    # With pages waiting for a slot the semaphore is locked even if one just freed.
+    if slots.locked():
+        # One slot frees up on average every average_seconds / MAX_INFLIGHT seconds.
+        retry_after = max(1, round(average_seconds * inflight / MAX_INFLIGHT))
+        return JSONResponse(
+            {"detail": "Scraper busy", "inflight": inflight},
+            status_code=429,
+            headers={"Retry-After": str(retry_after)},
+        )
+    if request.url.path == "/scrape":
+        async with tracked():
+            return await call_next(request)
+    return await call_next(request)
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "inflight": inflight, "max_inflight": MAX_INFLIGHT}
 
 
 @app.post("/scrape")
 async def scrape_url(url: str):
     try:
-        html = await scrape_with_browser(url)
+        html, _ = await scrape_with_browser(url)
     except TimeoutError:
         raise HTTPException(status_code=408, detail="Not fast enough")
     return {"html": html}
 
 
+class BatchRequest(BaseModel):
+    urls: list[str]
+    text_only: bool = False
+
+
+async def scrape_result(url: str, text_only: bool, semaphore: asyncio.Semaphore) -> dict:
+    """Scrapes one url of a batch, errors are reported in its result."""
+
+    async with semaphore, tracked():
+        try:
+            html, status = await scrape_with_browser(url)
+        except TimeoutError:
+            return {"url": url, "status": 408, "error": "Not fast enough"}
+        except Exception as e:
+            return {"url": url, "status": 502, "error": str(e)}
+
+    if text_only:
+        # BeautifulSoup parses for tens of milliseconds, off the event loop.
+        text = await asyncio.to_thread(extract_text, html)
+        return {"url": url, "status": status, "text": text}
+    return {"url": url, "status": status, "html": html}
+
+
+@app.post("/scrape/batch")
+async def scrape_batch(batch: BatchRequest, request: Request):
+    """Scrapes the urls concurrently, streaming every result as a NDJSON line as soon as it is ready.
+
+    With Accept-Encoding gzip the stream is compressed, flushing after every
+    line so the client can decode each result without waiting for the rest.
+    """
+
+    if len(batch.urls) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413, detail=f"At most {MAX_BATCH_SIZE} urls per batch"
+        )
+
+    gzip = "gzip" in request.headers.get("accept-encoding", "")
+
+    async def results():
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+        tasks = [
+            asyncio.create_task(scrape_result(url, batch.text_only, semaphore))
+            for url in batch.urls
+        ]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+        try:
+            for task in asyncio.as_completed(tasks):
+                line = (json.dumps(await task) + "\n").encode("utf-8")
+                if compressor is None:
+                    yield line
+                else:
+                    yield compressor.compress(line) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if compressor is not None:
+                yield compressor.flush()
+        finally:
+            # The client went away: the pages still pending are not rendered.
+            for task in tasks:
+                task.cancel()
+
+    headers = {"Content-Encoding": "gzip"} if gzip else {}
+    return StreamingResponse(
+        results(), media_type="application/x-ndjson", headers=headers
+    )
+
+
 if __name__ == "__main__":
     import uvicorn
 